@@ -1,7 +1,15 @@
+import asyncio
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from telegram import Bot, Message, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, ConversationHandler, MessageHandler, CallbackQueryHandler, filters
-from db import Database
+from db import AsyncDatabase
+from broadcast import BroadcastManager, JOB_BROADCAST
+from metrics import summary_lines
+from payloads import ReplyPayloads
+from profiling import PROFILER
+from scheduler import AUTO_MODE_BATCH, AUTO_MODE_SPREAD
 
 logger = logging.getLogger(__name__)
 
@@ -9,16 +17,32 @@ logger = logging.getLogger(__name__)
 WAITING_CHANNEL_LINK, WAITING_BUTTON_TEXT, WAITING_CAPTION, WAITING_IMAGE, \
 WAITING_AUTO_MESSAGE, WAITING_INTERVAL, WAITING_BROADCAST, WAITING_FILE, WAITING_FILE_BUTTON_TEXT = range(9)
 
+# An album arrives as one message per item; it is broadcast once no item came for this long
+ALBUM_COLLECT_SECONDS = 1.5
+
 
 class AdminPanel:
-    def __init__(self, db: Database, admin_ids: list):
+    def __init__(self, db: AsyncDatabase, admin_ids: list, broadcasts: BroadcastManager, payloads: ReplyPayloads):
         self.db = db
         self.admin_ids = admin_ids
+        self.broadcasts = broadcasts
+        self.payloads = payloads
+        # Set by bot.py to the Bot with the bulk connection pool
+        self.bulk_bot: Optional[Bot] = None
+        self._profile_task: Optional[asyncio.Task] = None
+        # Albums being broadcast, by media_group_id, until all their items have arrived
+        self._albums: Dict[str, List[Message]] = {}
+        self._album_tasks: Set[asyncio.Task] = set()
 
     def is_admin(self, user_id: int) -> bool:
         """Check if user is admin"""
         return user_id in self.admin_ids
 
+    async def _set_setting(self, key: str, value: str):
+        """Save a setting and rebuild any user-facing reply that uses it"""
+        await self.db.set_setting(key, value)
+        self.payloads.refresh(key)
+
     async def admin_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show admin menu"""
         if not self.is_admin(update.effective_user.id):
@@ -30,18 +54,22 @@ class AdminPanel:
             [InlineKeyboardButton("🔘 Edit Button Text", callback_data="admin_edit_button_text")],
             [InlineKeyboardButton("📄 Edit Caption", callback_data="admin_edit_caption")],
             [InlineKeyboardButton("🖼️ Upload / Change Image", callback_data="admin_edit_image")],
-            [InlineKeyboardButton("📁 Upload File (APK/Images/Documents)", callback_data="admin_upload_file")],
+            [InlineKeyboardButton("📁 Add File (APK/Images/Documents)", callback_data="admin_upload_file")],
+            [InlineKeyboardButton("🗑 Clear Files", callback_data="admin_clear_files")],
             [InlineKeyboardButton("🔘 Edit File Button Text", callback_data="admin_edit_file_button_text")],
             [InlineKeyboardButton("💬 Edit Auto Message", callback_data="admin_edit_auto_message")],
             [InlineKeyboardButton("⏰ Set Interval Hours", callback_data="admin_edit_interval")],
             [InlineKeyboardButton("🔄 Toggle Auto Messages", callback_data="admin_toggle_auto")],
+            [InlineKeyboardButton("🔀 Toggle Auto Delivery Mode", callback_data="admin_toggle_auto_mode")],
             [InlineKeyboardButton("📢 Broadcast Now", callback_data="admin_broadcast")],
             [InlineKeyboardButton("📊 Stats", callback_data="admin_stats")],
+            [InlineKeyboardButton("🔬 Capture Profile", callback_data="admin_profile")],
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         auto_status = "ON" if self.db.get_setting("auto_messages_enabled") == "1" else "OFF"
-        text = f"👑 **Admin Panel**\n\nAuto Messages: {auto_status}"
+        auto_mode = self.db.get_setting("auto_message_mode") or AUTO_MODE_BATCH
+        text = f"👑 **Admin Panel**\n\nAuto Messages: {auto_status} ({auto_mode})"
         await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
 
     async def admin_callback_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -114,11 +142,22 @@ class AdminPanel:
         elif callback_data == "admin_toggle_auto":
             current = self.db.get_setting("auto_messages_enabled")
             new_value = "0" if current == "1" else "1"
-            self.db.set_setting("auto_messages_enabled", new_value)
+            await self._set_setting("auto_messages_enabled", new_value)
             status = "ON" if new_value == "1" else "OFF"
             await query.edit_message_text(f"✅ Auto messages turned {status}")
             return ConversationHandler.END
 
+        elif callback_data == "admin_toggle_auto_mode":
+            current = self.db.get_setting("auto_message_mode") or AUTO_MODE_BATCH
+            new_mode = AUTO_MODE_BATCH if current == AUTO_MODE_SPREAD else AUTO_MODE_SPREAD
+            await self._set_setting("auto_message_mode", new_mode)
+            if new_mode == AUTO_MODE_SPREAD:
+                description = "each user gets the auto message one interval after their previous one"
+            else:
+                description = "all users get the auto message together once per interval"
+            await query.edit_message_text(f"✅ Auto delivery mode set to {new_mode}: {description}")
+            return ConversationHandler.END
+
         elif callback_data == "admin_broadcast":
             await query.edit_message_text(
                 "📢 **Broadcast Message**\n\n"
@@ -129,8 +168,9 @@ class AdminPanel:
 
         elif callback_data == "admin_upload_file":
             await query.edit_message_text(
-                "📁 **Upload File**\n\n"
-                "Please send a file (APK, image, document, video, audio, etc.):\n\n"
+                "📁 **Add File**\n\n"
+                f"The download button currently sends {len(self.payloads.file.files)} file(s). "
+                "Please send a file to add (APK, image, document, video, audio, etc.):\n\n"
                 "Supported formats:\n"
                 "• APK files\n"
                 "• Images (JPG, PNG, etc.)\n"
@@ -141,6 +181,12 @@ class AdminPanel:
             )
             return WAITING_FILE
 
+        elif callback_data == "admin_clear_files":
+            await self.db.clear_files()
+            self.payloads.file.rebuild([])
+            await query.edit_message_text("✅ All files removed. The download button has nothing to send until you add a file.")
+            return ConversationHandler.END
+
         elif callback_data == "admin_edit_file_button_text":
             current_text = self.db.get_setting("file_button_text") or "📥 Download Files"
             await query.edit_message_text(
@@ -152,16 +198,38 @@ class AdminPanel:
             return WAITING_FILE_BUTTON_TEXT
 
         elif callback_data == "admin_stats":
-            stats = self.db.get_stats()
+            stats = await self.db.get_stats()
             text = (
                 f"📊 **Bot Statistics**\n\n"
                 f"Total Users: {stats['total_users']}\n"
                 f"Active Users: {stats['active_users']}\n"
-                f"Inactive Users: {stats['total_users'] - stats['active_users']}"
+                f"Inactive Users: {stats['total_users'] - stats['active_users']}\n\n"
+                f"⏱ **Performance (since start)**\n" + "\n".join(summary_lines())
             )
             await query.edit_message_text(text, parse_mode="Markdown")
             return ConversationHandler.END
 
+        elif callback_data == "admin_profile":
+            if PROFILER.capturing:
+                await query.edit_message_text("🔬 A profile capture is already running.")
+                return ConversationHandler.END
+            await query.edit_message_text(
+                f"🔬 Profiling the bot for {PROFILER.capture_seconds:.0f}s. "
+                "It runs slower meanwhile; the results will follow in a new message."
+            )
+            self._profile_task = asyncio.create_task(self._send_profile(context.bot, query.message.chat_id))
+            return ConversationHandler.END
+
+    async def _send_profile(self, bot: Bot, chat_id: int):
+        """Run a profile capture and send its summary to the admin who asked for it"""
+        try:
+            summary = await PROFILER.capture()
+        except Exception as e:
+            logger.error(f"Profile capture failed: {e}", exc_info=True)
+            summary = f"❌ Profile capture failed: {e}"
+        # Plain text: function names are full of Markdown characters
+        await bot.send_message(chat_id=chat_id, text=summary[:4000])
+
     async def handle_channel_link(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle channel link update"""
         try:
@@ -206,7 +274,7 @@ class AdminPanel:
             
             # Save the link
             logger.info(f"Saving channel link: {new_link}")
-            self.db.set_setting("channel_link", new_link)
+            await self._set_setting("channel_link", new_link)
             
             # Verify it was saved
             saved_link = self.db.get_setting("channel_link")
@@ -230,14 +298,14 @@ class AdminPanel:
     async def handle_button_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle button text update"""
         new_text = update.message.text.strip()
-        self.db.set_setting("button_text", new_text)
+        await self._set_setting("button_text", new_text)
         await update.message.reply_text(f"✅ Button text updated to: {new_text}")
         return ConversationHandler.END
 
     async def handle_caption(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle caption update"""
         new_caption = update.message.text
-        self.db.set_setting("caption_text", new_caption)
+        await self._set_setting("caption_text", new_caption)
         await update.message.reply_text("✅ Caption updated successfully!")
         return ConversationHandler.END
 
@@ -250,14 +318,14 @@ class AdminPanel:
         # Get the largest photo
         photo = update.message.photo[-1]
         file_id = photo.file_id
-        self.db.set_setting("image_file_id", file_id)
+        await self._set_setting("image_file_id", file_id)
         await update.message.reply_text("✅ Image updated successfully!")
         return ConversationHandler.END
 
     async def handle_auto_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle auto message update"""
         new_message = update.message.text
-        self.db.set_setting("auto_message_text", new_message)
+        await self._set_setting("auto_message_text", new_message)
         await update.message.reply_text("✅ Auto message text updated successfully!")
         return ConversationHandler.END
 
@@ -267,7 +335,7 @@ class AdminPanel:
             hours = int(update.message.text.strip())
             if hours < 1:
                 raise ValueError("Hours must be at least 1")
-            self.db.set_setting("interval_hours", str(hours))
+            await self._set_setting("interval_hours", str(hours))
             await update.message.reply_text(f"✅ Interval updated to {hours} hours")
         except ValueError as e:
             await update.message.reply_text(f"❌ Invalid input: {e}. Please send a number.")
@@ -275,111 +343,125 @@ class AdminPanel:
         return ConversationHandler.END
 
     async def handle_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle broadcast message"""
-        message_text = update.message.text or update.message.caption
-        photo_file_id = None
-        if update.message.photo:
-            photo_file_id = update.message.photo[-1].file_id
-        
-        if not message_text and not photo_file_id:
-            await update.message.reply_text("❌ Please send a text message or photo with caption.")
+        """Handle broadcast message: any kind of message, copied to every user as it is"""
+        message = update.message
+        if not message.text and not message.effective_attachment:
+            await update.message.reply_text("❌ Please send a message, photo, video, file or album to broadcast.")
             return WAITING_BROADCAST
         
-        # Import here to avoid circular import
-        import asyncio
-        from telegram.error import TelegramError
-        
-        users = self.db.get_active_users()
-        status_msg = await update.message.reply_text(f"📢 Broadcasting to {len(users)} users...")
-        
-        success_count = 0
-        failed_count = 0
-        
-        bot = context.bot
+        if message.media_group_id:
+            self._collect_album(message, lambda album: self._start_broadcast(album, context.bot))
+            return ConversationHandler.END
         
-        for user in users:
-            try:
-                if photo_file_id:
-                    await bot.send_photo(
-                        chat_id=user["user_id"],
-                        photo=photo_file_id,
-                        caption=message_text
-                    )
-                else:
-                    await bot.send_message(
-                        chat_id=user["user_id"],
-                        text=message_text
-                    )
-                success_count += 1
-                await asyncio.sleep(0.05)  # Rate limiting
-                
-            except TelegramError as e:
-                logger.warning(f"Failed to broadcast to user {user['user_id']}: {e}")
-                if "blocked" in str(e).lower() or "chat not found" in str(e).lower():
-                    self.db.mark_user_inactive(user["user_id"])
-                failed_count += 1
+        await self._start_broadcast([message], context.bot)
+        return ConversationHandler.END
+
+    def _collect_album(self, message: Message, on_complete: Callable[[List[Message]], Awaitable]):
+        """Gather the album message starts and pass all of its items to on_complete
+
+        The other items arrive as separate updates after the conversation has ended; they
+        are picked up by handle_album_item.
+        """
+        self._albums[message.media_group_id] = [message]
+        task = asyncio.create_task(self._finish_album(message.media_group_id, on_complete))
+        self._album_tasks.add(task)
+        task.add_done_callback(self._album_tasks.discard)
+
+    async def handle_album_item(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Collect the remaining items of an album sent as a broadcast or file upload"""
+        album = self._albums.get(update.message.media_group_id)
+        if album is not None and self.is_admin(update.effective_user.id):
+            album.append(update.message)
+
+    async def _finish_album(self, media_group_id: str, on_complete: Callable[[List[Message]], Awaitable]):
+        """Wait until the album is complete, then hand its items over in order"""
+        album = self._albums[media_group_id]
+        collected = 0
+        while collected != len(album):
+            collected = len(album)
+            await asyncio.sleep(ALBUM_COLLECT_SECONDS)
+        del self._albums[media_group_id]
+        try:
+            await on_complete(sorted(album, key=lambda message: message.message_id))
+        except Exception as e:
+            logger.error(f"Failed to handle album {media_group_id}: {e}", exc_info=True)
+
+    async def _start_broadcast(self, messages: List[Message], bot: Bot):
+        """Create and start a job that copies messages (one, or an album) to every user"""
+        first = messages[0]
+        # Sender bots other than the main one cannot copy; they send the same files themselves,
+        # or, for anything else (a sticker, a poll), this text and photo
+        message_text = next((message.caption_html for message in messages if message.caption), None)
+        if message_text is None and first.text:
+            message_text = first.text_html
+        photo_file_id = first.photo[-1].file_id if first.photo else None
+        media = self._broadcast_media(messages)
         
-        await status_msg.edit_text(
-            f"📢 Broadcast completed!\n✅ Success: {success_count}\n❌ Failed: {failed_count}"
+        status_msg = await first.reply_text("📢 Preparing broadcast...")
+        job_id = await self.broadcasts.create_job(
+            JOB_BROADCAST,
+            message_text,
+            photo=photo_file_id,
+            status_chat_id=status_msg.chat_id,
+            status_message_id=status_msg.message_id,
+            from_chat_id=first.chat_id,
+            message_ids=[message.message_id for message in messages],
+            media=media,
+            parse_mode=ParseMode.HTML
         )
+        job = await self.db.get_broadcast_job(job_id)
+        await status_msg.edit_text(f"📢 Broadcasting to {job['total']} users...")
         
-        return ConversationHandler.END
+        # Deliver in the background; progress is checkpointed so a restart resumes it
+        self.broadcasts.start_job(job_id, self.bulk_bot or bot)
+
+    @classmethod
+    def _broadcast_media(cls, messages: List[Message]) -> Optional[List[Dict]]:
+        """The files in messages for send_media (none for a text message), or None if one has no file"""
+        media = []
+        for message in messages:
+            if message.text:
+                continue
+            info = cls._file_info(message)
+            if info is None:
+                return None
+            file_id, file_type, file_name = info
+            media.append({
+                "file_id": file_id, "file_type": file_type, "file_name": file_name, "caption": message.caption_html
+            })
+        return media
+
+    @staticmethod
+    def _file_info(message: Message) -> Optional[Tuple[str, str, str]]:
+        """(file_id, file_type, file_name) of the file in message, or None if it has none"""
+        if message.document:
+            return message.document.file_id, "document", message.document.file_name or "file"
+        if message.photo:
+            # Get the largest photo
+            return message.photo[-1].file_id, "photo", "photo.jpg"
+        if message.video:
+            return message.video.file_id, "video", message.video.file_name or "video.mp4"
+        if message.audio:
+            return message.audio.file_id, "audio", message.audio.file_name or "audio.mp3"
+        if message.voice:
+            return message.voice.file_id, "audio", "voice.ogg"
+        if message.video_note:
+            return message.video_note.file_id, "video", "video_note.mp4"
+        return None
 
     async def handle_file_upload(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle file upload (APK, images, documents, etc.)"""
+        """Handle file upload (APK, images, documents, etc.), or a whole album of them"""
         try:
-            file_id = None
-            file_type = None
-            file_name = None
-            
-            # Check for different file types
-            if update.message.document:
-                file_id = update.message.document.file_id
-                file_type = "document"
-                file_name = update.message.document.file_name or "file"
-            elif update.message.photo:
-                # Get the largest photo
-                file_id = update.message.photo[-1].file_id
-                file_type = "photo"
-                file_name = "photo.jpg"
-            elif update.message.video:
-                file_id = update.message.video.file_id
-                file_type = "video"
-                file_name = update.message.video.file_name or "video.mp4"
-            elif update.message.audio:
-                file_id = update.message.audio.file_id
-                file_type = "audio"
-                file_name = update.message.audio.file_name or "audio.mp3"
-            elif update.message.voice:
-                file_id = update.message.voice.file_id
-                file_type = "audio"
-                file_name = "voice.ogg"
-            elif update.message.video_note:
-                file_id = update.message.video_note.file_id
-                file_type = "video"
-                file_name = "video_note.mp4"
-            else:
+            if self._file_info(update.message) is None:
                 await update.message.reply_text("❌ Please send a file (document, photo, video, or audio).")
                 return WAITING_FILE
             
-            # Save file information
-            self.db.set_setting("file_id", file_id)
-            self.db.set_setting("file_type", file_type)
-            if file_name:
-                self.db.set_setting("file_name", file_name)
-            
-            # Get or set default caption
-            file_caption = update.message.caption or f"📥 {file_name}"
-            self.db.set_setting("file_caption", file_caption)
+            if update.message.media_group_id:
+                # Every item of the album goes into the bundle, once all of them have arrived
+                self._collect_album(update.message, self._add_files)
+                return ConversationHandler.END
             
-            await update.message.reply_text(
-                f"✅ File uploaded successfully!\n\n"
-                f"Type: {file_type}\n"
-                f"Name: {file_name}\n"
-                f"Caption: {file_caption}\n\n"
-                f"Users can now download this file by clicking the download button."
-            )
-            logger.info(f"File uploaded: {file_type} - {file_name}")
+            await self._add_files([update.message])
             return ConversationHandler.END
             
         except Exception as e:
@@ -387,10 +469,32 @@ class AdminPanel:
             await update.message.reply_text(f"❌ An error occurred: {str(e)}")
             return WAITING_FILE
 
+    async def _add_files(self, messages: List[Message]):
+        """Append the files in messages to the bundle and confirm to the admin"""
+        added = []
+        count = 0
+        for message in messages:
+            info = self._file_info(message)
+            if info is None:
+                continue
+            file_id, file_type, file_name = info
+            file_caption = message.caption or f"📥 {file_name}"
+            count = await self.db.add_file(file_id, file_type, file_name, file_caption)
+            added.append(f"• {file_type}: {file_name}")
+            logger.info(f"File uploaded: {file_type} - {file_name}")
+        # Rebuild the prebuilt download reply once for the whole upload
+        self.payloads.file.rebuild(await self.db.get_files())
+        
+        await messages[0].reply_text(
+            f"✅ {len(added)} file(s) added to the download bundle!\n\n"
+            + "\n".join(added) +
+            f"\n\nThe download button now sends {count} file(s). Use 📁 Add File again to add more."
+        )
+
     async def handle_file_button_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle file button text update"""
         new_text = update.message.text.strip()
-        self.db.set_setting("file_button_text", new_text)
+        await self._set_setting("file_button_text", new_text)
         await update.message.reply_text(f"✅ File button text updated to: {new_text}")
         return ConversationHandler.END
 
@@ -414,3 +518,8 @@ class AdminPanel:
             per_user=True,
         )
 
+    def get_album_handler(self):
+        """Get the handler for album items that follow the first one of a broadcast"""
+        # Registered after the conversation handler, which has already ended by then
+        return MessageHandler(filters.User(self.admin_ids) & filters.ATTACHMENT, self.handle_album_item)
+
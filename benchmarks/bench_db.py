@@ -0,0 +1,92 @@
+"""Microbenchmark for Database operations.
+
+Compares the original connection-per-call behaviour against the shared WAL
+connection used by db.Database. Run from the project root:
+
+    python benchmarks/bench_db.py --ops 5000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database  # noqa: E402
+
+
+class PerCallConnectionDatabase(Database):
+    """Database with the old behaviour: a fresh connection with default pragmas per call,
+    settings read from the table on every lookup and stats counted with full scans"""
+
+    def _connect(self):
+        return None
+
+    @contextmanager
+    def _get_connection(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def get_setting(self, key):
+        with self._get_connection() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+            return row["value"] if row else None
+
+    def get_stats(self):
+        with self._get_connection() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            active = conn.execute("SELECT COUNT(*) FROM users WHERE is_active = 1").fetchone()[0]
+            return {"total_users": total, "active_users": active}
+
+
+def measure(func, ops: int) -> float:
+    """Run func(i) ops times and return operations per second"""
+    start = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    return ops / (time.perf_counter() - start)
+
+
+def run(db_class, ops: int, users: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = db_class(os.path.join(tmp, "bench.db"))
+        for user_id in range(1, users + 1):
+            db.add_user(user_id, f"user{user_id}", "Bench")
+
+        results = {
+            "add_user": measure(lambda i: db.add_user(users + i + 1, "new", "User"), ops),
+            "get_setting": measure(lambda i: db.get_setting("caption_text"), ops),
+            "update_last_message_sent": measure(lambda i: db.update_last_message_sent(i % users + 1), ops),
+            "get_stats": measure(lambda i: db.get_stats(), max(1, ops // 10)),
+        }
+        db.close()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ops", type=int, default=2000, help="operations per measurement")
+    parser.add_argument("--users", type=int, default=10000, help="users seeded before measuring")
+    args = parser.parse_args()
+
+    before = run(PerCallConnectionDatabase, args.ops, args.users)
+    after = run(Database, args.ops, args.users)
+
+    print(f"{'operation':<28}{'before ops/s':>14}{'after ops/s':>14}{'speedup':>10}")
+    for name in before:
+        print(f"{name:<28}{before[name]:>14.0f}{after[name]:>14.0f}{after[name] / before[name]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
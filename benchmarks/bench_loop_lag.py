@@ -0,0 +1,96 @@
+"""Event-loop lag while handlers write to SQLite.
+
+Simulates bursts of /start registrations, first calling Database directly from
+coroutines (the old behaviour) and then awaiting the same calls through
+AsyncDatabase, while EventLoopLagMonitor samples how late the loop wakes up.
+Run from the project root:
+
+    python benchmarks/bench_loop_lag.py --users 20000 --stall-ms 2
+
+--stall-ms adds a synchronous sleep to every write to mimic a contended disk.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database, AsyncDatabase  # noqa: E402
+from monitoring import EventLoopLagMonitor  # noqa: E402
+
+
+async def simulate(register, users: int, concurrency: int) -> dict:
+    monitor = EventLoopLagMonitor(interval=0.005, report_every=0)
+    monitor.start()
+    queue = iter(range(1, users + 1))
+
+    async def handler():
+        for user_id in queue:
+            await register(user_id)
+            # Stand-in for the reply_photo round trip
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(handler() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    monitor.stop()
+
+    stats = monitor.snapshot()
+    return {
+        "registrations_per_sec": users / elapsed,
+        "avg_lag_ms": stats["avg_lag"] * 1000,
+        "max_lag_ms": stats["max_lag"] * 1000,
+    }
+
+
+async def run(users: int, concurrency: int, stall_ms: float) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        adb = AsyncDatabase(db)
+
+        if stall_ms:
+            add_user = db.add_user
+
+            def stalled_add_user(*args, **kwargs):
+                time.sleep(stall_ms / 1000)
+                return add_user(*args, **kwargs)
+
+            db.add_user = stalled_add_user
+
+        async def blocking_register(user_id: int):
+            db.add_user(user_id, "user", "Bench")
+
+        async def async_register(user_id: int):
+            await adb.add_user(user_id, "user", "Bench")
+
+        results = {
+            "blocking": await simulate(blocking_register, users, concurrency),
+            "async": await simulate(async_register, users, concurrency),
+        }
+        adb.close()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000, help="registrations per run")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent handlers")
+    parser.add_argument("--stall-ms", type=float, default=0.0, help="simulated disk stall per write")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    results = asyncio.run(run(args.users, args.concurrency, args.stall_ms))
+    print(f"{'mode':<10}{'regs/s':>10}{'avg lag ms':>12}{'max lag ms':>12}")
+    for mode, stats in results.items():
+        print(
+            f"{mode:<10}{stats['registrations_per_sec']:>10.0f}"
+            f"{stats['avg_lag_ms']:>12.2f}{stats['max_lag_ms']:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
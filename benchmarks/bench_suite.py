@@ -0,0 +1,280 @@
+"""Benchmark suite: the real bot against the fake Bot API at several audience sizes.
+
+For every size in --sizes a fresh database is seeded with that many synthetic users
+and a child process measures:
+
+* db: operations per second of common Database calls on that database
+* start: /start throughput and reply latency through the real Application (long polling)
+* auto: messages per second of MessageScheduler.send_auto_messages
+* broadcast: messages per second of an admin broadcast sent through the /admin
+  conversation, i.e. AdminPanel.handle_broadcast
+
+Broadcasts run for --send-seconds and are then stopped, so the rate is comparable
+between sizes. The fake API can add latency, 429 flood waits and blocked users.
+Results are printed as a table and, with --output, written as JSON together with the
+git commit and settings, so runs can be compared across releases. Run from the project
+root:
+
+    python benchmarks/bench_suite.py --sizes 10000,100000,1000000 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import PROJECT_ROOT, import_bot, summarize_latencies
+from fake_bot_api import FakeBotAPI
+from bench_db import measure
+
+ADMIN_ID = 1
+SEED_CHUNK = 50000
+# Synthetic users get ids from here upwards; /start users of the benchmark come after them
+FIRST_USER_ID = 10_000_000
+
+
+def seed_database(db_path: str, users: int) -> float:
+    """Create the database with `users` active users and quiet scheduler settings; returns seconds taken"""
+    from db import Database
+
+    start = time.perf_counter()
+    db = Database(db_path)
+    for first in range(0, users, SEED_CHUNK):
+        db.add_users_many([
+            (FIRST_USER_ID + i, f"user{i}", "Bench", 1) for i in range(first, min(users, first + SEED_CHUNK))
+        ])
+    # Batch mode with a run time far away keeps the scheduler loop from sending on its own
+    db.set_setting("auto_message_mode", "batch")
+    db.set_setting("auto_message_next_run", str(int(time.time()) + 365 * 86400))
+    db.set_setting("auto_message_text", "Benchmark auto message")
+    db.close()
+    return time.perf_counter() - start
+
+
+def bench_db(db_path: str, users: int, ops: int) -> dict:
+    """Operations per second of Database calls against the seeded database"""
+    from db import Database
+
+    db = Database(db_path)
+    new_user = FIRST_USER_ID * 2
+    results = {
+        "get_setting": measure(lambda i: db.get_setting("caption_text"), ops),
+        "add_user": measure(lambda i: db.add_user(new_user + i, "new", "User"), ops),
+        "update_last_message_sent": measure(
+            lambda i: db.update_last_message_sent(FIRST_USER_ID + i * 7919 % users), ops
+        ),
+        "get_stats": measure(lambda i: db.get_stats(), ops),
+        "get_active_users_page": measure(
+            lambda i: db.get_active_users_page(FIRST_USER_ID + i * 7919 % users, 1000), max(1, ops // 10)
+        ),
+    }
+    # Snapshotting the audience grows with its size, so report seconds per job instead of a rate
+    start = time.perf_counter()
+    job_id = db.create_broadcast_job("broadcast", {"text": "bench"})
+    results["create_broadcast_job_seconds"] = time.perf_counter() - start
+    db.finish_broadcast_job(job_id)
+    db.close()
+    return results
+
+
+async def bench_start(api: FakeBotAPI, requests: int, concurrency: int) -> dict:
+    """Send /start from `requests` new users, `concurrency` at a time, and time each reply"""
+    latencies = []
+    user_ids = iter(range(FIRST_USER_ID * 3, FIRST_USER_ID * 3 + requests))
+
+    async def client():
+        for user_id in user_ids:
+            reply = api.expect_reply(user_id)
+            sent_at = time.monotonic()
+            await api.inject(api.message_update(user_id))
+            latencies.append(await asyncio.wait_for(reply, timeout=30) - sent_at)
+
+    start = time.monotonic()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.monotonic() - start
+    return {"requests_per_sec": requests / elapsed, **summarize_latencies(latencies)}
+
+
+async def measure_sends(api: FakeBotAPI, bot, started, seconds: float, faults: tuple) -> dict:
+    """Let the broadcast started by the `started` coroutine run for `seconds`, then stop it
+
+    The time until the job's task exists (creating the job snapshots the audience) is
+    reported apart from the send rate. The (flood_rate, blocked_rate) faults only apply
+    while the job runs, so the admin's own replies always get through.
+    """
+    start = time.monotonic()
+    await started
+    while not bot.broadcasts._tasks:
+        await asyncio.sleep(0.01)
+    job_ready = time.monotonic()
+    sends_before = len(api.sends)
+
+    api.flood_rate, api.blocked_rate = faults
+    await asyncio.sleep(seconds)
+    api.flood_rate, api.blocked_rate = 0.0, 0.0
+    sent = len(api.sends) - sends_before
+    elapsed = time.monotonic() - job_ready
+    tasks = list(bot.broadcasts._tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {"job_start_seconds": job_ready - start, "messages": sent, "messages_per_sec": sent / elapsed}
+
+
+async def bench_auto(api: FakeBotAPI, bot, seconds: float, faults: tuple) -> dict:
+    """send_auto_messages in batch mode: one job for every active user"""
+    task = asyncio.create_task(bot.scheduler.send_auto_messages())
+    result = await measure_sends(api, bot, asyncio.sleep(0), seconds, faults)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    return result
+
+
+async def bench_broadcast(api: FakeBotAPI, bot, seconds: float, faults: tuple) -> dict:
+    """Walk through /admin -> Broadcast Now -> message text like an admin would"""
+    for update in (
+        api.message_update(ADMIN_ID, "/admin"),
+        api.callback_update(ADMIN_ID, "admin_broadcast"),
+    ):
+        reply = api.expect_reply(ADMIN_ID)
+        await api.inject(update)
+        await asyncio.wait_for(reply, timeout=30)
+    return await measure_sends(
+        api, bot, api.inject(api.message_update(ADMIN_ID, "Benchmark broadcast")), seconds, faults
+    )
+
+
+async def run_size(args) -> dict:
+    api = FakeBotAPI(latency=args.api_latency_ms / 1000)
+    await api.start()
+    results = {"users": args.size}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bot_database.db")
+        results["seed_seconds"] = seed_database(db_path, args.size)
+        results["db"] = bench_db(db_path, args.size, args.db_ops)
+
+        bot = import_bot(tmp)
+        app = bot.build_application(base_url=api.base_url)
+        await app.initialize()
+        await app.post_init(app)
+        await app.start()
+        await app.updater.start_polling(poll_interval=0.0, timeout=10, allowed_updates=bot.ALLOWED_UPDATES)
+
+        results["start"] = await bench_start(api, args.start_requests, args.start_concurrency)
+        # Flood waits and blocked users only hit broadcast sends; /start waits for every reply
+        faults = (args.flood_rate, args.blocked_rate)
+        results["auto"] = await bench_auto(api, bot, args.send_seconds, faults)
+        results["broadcast"] = await bench_broadcast(api, bot, args.send_seconds, faults)
+        results["api_calls"] = dict(api.calls)
+
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+    await api.stop()
+    return results
+
+
+def child_env(args) -> dict:
+    """Settings for the bot under test; config.py reads them at import"""
+    env = dict(os.environ)
+    env.update({
+        "ADMIN_IDS": str(ADMIN_ID),
+        "BROADCAST_RATE_LIMIT": str(args.rate_limit),
+        "METRICS_PORT": "0",
+        "LOOP_LAG_REPORT_INTERVAL": "0",
+        "SENDER_WORKERS": "0",
+        "SENDER_BOT_TOKENS": "",
+    })
+    env.pop("WEBHOOK_URL", None)
+    return env
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(results: dict):
+    print(f"{'users':>9}{'seed s':>8}{'/start rps':>12}{'p50 ms':>8}{'p99 ms':>8}"
+          f"{'auto msg/s':>12}{'bcast msg/s':>13}{'job s':>7}{'stats ops/s':>13}")
+    for run in results["runs"]:
+        print(
+            f"{run['users']:>9}{run['seed_seconds']:>8.1f}{run['start']['requests_per_sec']:>12.0f}"
+            f"{run['start']['p50_ms']:>8.1f}{run['start']['p99_ms']:>8.1f}"
+            f"{run['auto']['messages_per_sec']:>12.0f}{run['broadcast']['messages_per_sec']:>13.0f}"
+            f"{run['broadcast']['job_start_seconds']:>7.2f}{run['db']['get_stats']:>13.0f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated audience sizes")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)  # set for the per-size child process
+    parser.add_argument("--start-requests", type=int, default=500, help="/start updates per size")
+    parser.add_argument("--start-concurrency", type=int, default=50, help="users sending /start at once")
+    parser.add_argument("--send-seconds", type=float, default=5.0, help="how long each broadcast runs")
+    parser.add_argument("--rate-limit", type=float, default=1000.0,
+                        help="BROADCAST_RATE_LIMIT for the run; high, to find the bot's own ceiling")
+    parser.add_argument("--db-ops", type=int, default=2000, help="operations per database measurement")
+    parser.add_argument("--api-latency-ms", type=float, default=20.0, help="simulated Bot API round trip")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument("--blocked-rate", type=float, default=0.0, help="share of sends answered with 403")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = parser.parse_args()
+
+    if args.size is not None:
+        logging.basicConfig(level=logging.WARNING)
+        logging.disable(logging.INFO)
+        print(json.dumps(asyncio.run(run_size(args))))
+        return
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("size", "output", "json")}
+    results = {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": settings,
+        "runs": [],
+    }
+    passthrough = [
+        "--start-requests", str(args.start_requests), "--start-concurrency", str(args.start_concurrency),
+        "--send-seconds", str(args.send_seconds), "--rate-limit", str(args.rate_limit),
+        "--db-ops", str(args.db_ops), "--api-latency-ms", str(args.api_latency_ms),
+        "--flood-rate", str(args.flood_rate), "--blocked-rate", str(args.blocked_rate),
+    ]
+    for size in (int(size) for size in args.sizes.split(",") if size.strip()):
+        # bot.py builds its globals at import, so every size gets a fresh interpreter
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--size", str(size)] + passthrough,
+            env=child_env(args), capture_output=True, text=True
+        )
+        if child.returncode != 0:
+            sys.stderr.write(child.stderr)
+            sys.exit(f"Benchmark for {size} users failed")
+        results["runs"].append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Update-to-reply latency: long polling vs webhook.
+
+Runs the real Application from bot.py against benchmarks/fake_bot_api.py and
+measures the time from an update being handed to the (fake) Bot API until the
+bot's /start reply arrives back at it. Run from the project root:
+
+    python benchmarks/bench_webhook.py --requests 200 --api-latency-ms 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import tempfile
+import time
+
+import httpx
+
+from common import import_bot, summarize_latencies
+from fake_bot_api import FakeBotAPI
+
+WEBHOOK_SECRET = "bench-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def measure(api: FakeBotAPI, requests: int, first_user_id: int) -> dict:
+    latencies = []
+    for i in range(requests):
+        user_id = first_user_id + i
+        reply = api.expect_reply(user_id)
+        start = time.monotonic()
+        await api.inject(api.message_update(user_id))
+        latencies.append(await asyncio.wait_for(reply, timeout=10) - start)
+    return summarize_latencies(latencies)
+
+
+async def run(requests: int, api_latency: float) -> dict:
+    api = FakeBotAPI(latency=api_latency)
+    await api.start()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = import_bot(tmp)
+
+        # Long polling
+        app = bot.build_application(base_url=api.base_url)
+        await app.initialize()
+        await app.post_init(app)
+        await app.start()
+        await app.updater.start_polling(poll_interval=0.0, timeout=10, allowed_updates=bot.ALLOWED_UPDATES)
+        results["polling"] = await measure(api, requests, 100000)
+        await app.updater.stop()
+        await app.stop()
+        bot.scheduler.stop()
+        await app.shutdown()
+
+        # Webhook
+        port = free_port()
+        app = bot.build_application(base_url=api.base_url)
+        await app.initialize()
+        await app.post_init(app)
+        await app.start()
+        await app.updater.start_webhook(
+            listen="127.0.0.1",
+            port=port,
+            url_path="telegram",
+            webhook_url=f"http://127.0.0.1:{port}/telegram",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=bot.ALLOWED_UPDATES,
+        )
+        results["webhook"] = await measure(api, requests, 200000)
+
+        # Requests without the secret token must be refused
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                f"http://127.0.0.1:{port}/telegram", json=api.message_update(1),
+                headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+            )
+        results["webhook"]["bad_secret_status"] = response.status_code
+
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+    await api.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="/start updates per mode")
+    parser.add_argument("--api-latency-ms", type=float, default=20.0, help="simulated Bot API round trip")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logging.disable(logging.INFO)
+
+    results = asyncio.run(run(args.requests, args.api_latency_ms / 1000))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'mode':<10}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    for mode, stats in results.items():
+        print(
+            f"{mode:<10}{stats['mean_ms']:>10.1f}{stats['p50_ms']:>10.1f}"
+            f"{stats['p90_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+        )
+    print(f"webhook request with wrong secret token -> HTTP {results['webhook']['bad_secret_status']}")
+
+
+if __name__ == "__main__":
+    main()
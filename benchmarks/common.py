@@ -0,0 +1,45 @@
+"""Helpers shared by the benchmark scripts."""
+import os
+import sys
+from typing import Dict, List
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from fake_bot_api import DEFAULT_TOKEN  # noqa: E402
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of values (pct in 0..100)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize_latencies(latencies: List[float]) -> Dict:
+    """Mean and percentiles of latencies given in seconds, reported in milliseconds"""
+    count = len(latencies)
+    return {
+        "count": count,
+        "mean_ms": sum(latencies) / count * 1000 if count else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000 if count else 0.0,
+    }
+
+
+def import_bot(workdir: str):
+    """Import bot.py with a fake token, keeping its SQLite database inside workdir
+
+    bot.py builds its Database at import time in the current directory, so this
+    changes into workdir first. Call it once per process.
+    """
+    os.environ.setdefault("BOT_TOKEN", DEFAULT_TOKEN)
+    os.environ.setdefault("ADMIN_IDS", "1")
+    os.chdir(workdir)
+    import bot
+    return bot
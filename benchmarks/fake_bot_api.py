@@ -0,0 +1,264 @@
+"""A local stand-in for the Telegram Bot API, for benchmarks.
+
+Speaks just enough HTTP/1.1 (keep-alive, Content-Length bodies) for python-telegram-bot's
+httpx client. Point an Application at it with
+``Application.builder().base_url(api.base_url)``. Supports:
+
+* configurable latency per API call
+* injected 429 flood waits and 403 "blocked" errors at a given rate
+* long-polling ``getUpdates`` and webhook delivery of injected updates, per bot token
+* a record of every send call, and futures that resolve when a chat gets a reply
+* throttling a single bot token for a while, as Telegram does after a flood
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl
+
+import httpx
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+# Token injected updates go to unless another one is given
+DEFAULT_TOKEN = "123456:FAKE-TOKEN"
+
+# Methods whose result is a Message sent to the chat in the chat_id parameter
+SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "sendVideo", "sendAudio",
+    "copyMessage", "editMessageText", "editMessageCaption",
+}
+
+
+class FakeBotAPI:
+    """In-process fake Bot API server"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 flood_rate: float = 0.0, blocked_rate: float = 0.0, retry_after: int = 1):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.blocked_rate = blocked_rate
+        self.retry_after = retry_after
+        self.calls: Dict[str, int] = {}
+        # (method, chat_id, monotonic time, token) per successful send
+        self.sends: List[tuple] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._updates: Dict[str, asyncio.Queue] = {}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._reply_waiters: Dict[int, List[asyncio.Future]] = {}
+        # token -> (url, secret_token) set by setWebhook
+        self._webhooks: Dict[str, tuple] = {}
+        self._throttled_until: Dict[str, float] = {}
+        self._webhook_client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._webhook_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100))
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._webhook_client:
+            await self._webhook_client.aclose()
+
+    # -- update injection -------------------------------------------------------------
+
+    def message_update(self, user_id: int, text: str = "/start") -> Dict:
+        """Build a private-chat message update from user_id"""
+        user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback_update(self, user_id: int, data: str) -> Dict:
+        """Build an inline button press from user_id"""
+        user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": BOT_USER,
+            "text": "menu",
+        }
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {"id": str(next(self._message_ids)), "from": user, "chat_instance": "1",
+                               "message": message, "data": data},
+        }
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        """Future resolved with the monotonic time of the next send to chat_id"""
+        future = asyncio.get_running_loop().create_future()
+        self._reply_waiters.setdefault(chat_id, []).append(future)
+        return future
+
+    def _update_queue(self, token: str) -> asyncio.Queue:
+        if token not in self._updates:
+            self._updates[token] = asyncio.Queue()
+        return self._updates[token]
+
+    async def inject(self, update: Dict, token: str = DEFAULT_TOKEN):
+        """Deliver an update to the bot with token, by webhook if one is set, otherwise via getUpdates"""
+        webhook = self._webhooks.get(token)
+        if webhook:
+            url, secret = webhook
+            headers = {}
+            if secret:
+                headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+            await self._webhook_client.post(url, json=update, headers=headers)
+        else:
+            self._update_queue(token).put_nowait(update)
+
+    def throttle(self, token: str, seconds: float):
+        """Answer every send from token with a flood wait for the next `seconds`"""
+        self._throttled_until[token] = time.monotonic() + seconds
+
+    # -- HTTP plumbing ----------------------------------------------------------------
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode()
+                    if line in ("\r\n", "\n", ""):
+                        break
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                # Paths look like /bot<token>/<method>
+                token_part, method = path.rsplit("/", 2)[-2:]
+                params = self._parse_params(headers.get("content-type", ""), body)
+                status, response = await self._dispatch(token_part[len("bot"):], method, params)
+
+                payload = json.dumps(response).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: keep-alive\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Client went away, or the benchmark finished while a long poll was waiting
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type: str, body: bytes) -> Dict:
+        if not body:
+            return {}
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        # python-telegram-bot form-encodes parameters with JSON-encoded non-string values
+        params = {}
+        for key, value in parse_qsl(body.decode()):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    # -- Bot API methods --------------------------------------------------------------
+
+    def _message(self, chat_id: int, params: Dict) -> Dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text") or params.get("caption") or "",
+        }
+
+    async def _dispatch(self, token: str, method: str, params: Dict):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(token, params)}
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method == "setWebhook":
+            if params.get("url"):
+                self._webhooks[token] = (params["url"], params.get("secret_token"))
+            else:
+                self._webhooks.pop(token, None)
+            return 200, {"ok": True, "result": True}
+        if method == "deleteWebhook":
+            self._webhooks.pop(token, None)
+            return 200, {"ok": True, "result": True}
+        if method in ("answerCallbackQuery", "close", "logOut"):
+            return 200, {"ok": True, "result": True}
+
+        if method in SEND_METHODS or method == "sendMediaGroup" or method == "copyMessages":
+            throttled_for = self._throttled_until.get(token, 0.0) - time.monotonic()
+            if throttled_for > 0:
+                retry_after = max(1, int(throttled_for + 0.999))
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {retry_after}",
+                             "parameters": {"retry_after": retry_after}}
+            if self.flood_rate and random.random() < self.flood_rate:
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+            if self.blocked_rate and random.random() < self.blocked_rate:
+                return 403, {"ok": False, "error_code": 403,
+                             "description": "Forbidden: bot was blocked by the user"}
+
+            chat_id = int(params.get("chat_id", 0))
+            now = time.monotonic()
+            self.sends.append((method, chat_id, now, token))
+            for future in self._reply_waiters.pop(chat_id, []):
+                if not future.done():
+                    future.set_result(now)
+
+            if method == "sendMediaGroup":
+                return 200, {"ok": True, "result": [self._message(chat_id, item) for item in params.get("media", [])]}
+            if method == "copyMessage":
+                return 200, {"ok": True, "result": {"message_id": next(self._message_ids)}}
+            if method == "copyMessages":
+                return 200, {"ok": True, "result": [{"message_id": next(self._message_ids)}
+                                                    for _ in params.get("message_ids", [])]}
+            return 200, {"ok": True, "result": self._message(chat_id, params)}
+
+        return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: fake API has no {method}"}
+
+    async def _get_updates(self, token: str, params: Dict) -> List[Dict]:
+        queue = self._update_queue(token)
+        timeout = float(params.get("timeout", 0))
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(queue.get(), timeout=timeout or 0.01))
+        except asyncio.TimeoutError:
+            return []
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        while not queue.empty() and len(updates) < int(params.get("limit", 100)):
+            updates.append(queue.get_nowait())
+        return updates
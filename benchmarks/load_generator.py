@@ -0,0 +1,239 @@
+"""Synthetic update load on the handler pipeline, without any network.
+
+Builds Update objects for a mix of scenarios and feeds them through the bot's update
+processor into Application.process_update at a target rate. Bot API calls made by the
+handlers are answered in memory by FakeBotAPI (optionally after --api-latency-ms).
+Scenarios:
+
+* start: a new user sends /start
+* download: a user presses the download button
+* admin: /admin, "Edit Caption", then the new caption text (the AdminPanel conversation)
+
+Each rate in --rates runs for --seconds. For every step it reports the latency of each
+handler step (measured from when the update was due, so falling behind shows up as
+latency), event-loop lag and peak traced memory. The ramp stops at the first rate the bot
+cannot keep up with. Run from the project root:
+
+    python benchmarks/load_generator.py --rates 50,100,200,400,800 --seconds 10
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+from common import import_bot, summarize_latencies
+from fake_bot_api import DEFAULT_TOKEN, FakeBotAPI
+from monitoring import EventLoopLagMonitor
+
+ADMIN_IDS = list(range(1, 51))
+FIRST_USER_ID = 1_000_000
+
+
+class InMemoryRequest(BaseRequest):
+    """BaseRequest that answers Bot API calls with FakeBotAPI's responses, without sockets"""
+
+    def __init__(self, api: FakeBotAPI, token: str = DEFAULT_TOKEN):
+        self.api = api
+        self.token = token
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        params = request_data.parameters if request_data else {}
+        status, response = await self.api._dispatch(self.token, url.rsplit("/", 1)[-1], params)
+        return status, json.dumps(response).encode()
+
+
+class LoadGenerator:
+    """Starts scenarios at a fixed rate and records how long each of their updates takes"""
+
+    def __init__(self, app, api: FakeBotAPI, mix: Dict[str, float]):
+        self.app = app
+        self.api = api
+        self.scenarios = list(mix)
+        self.weights = list(mix.values())
+        self.user_ids = itertools.count(FIRST_USER_ID)
+        self.admins: asyncio.Queue = asyncio.Queue()
+        for admin_id in ADMIN_IDS:
+            self.admins.put_nowait(admin_id)
+        self.captions = itertools.count(1)
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors = 0
+
+    async def _feed(self, step: str, data: Dict, due: float):
+        update = Update.de_json(data, self.app.bot)
+        try:
+            # The same path Application takes for fetched updates, including concurrency limits
+            await self.app.update_processor.process_update(update, self.app.process_update(update))
+        except Exception:
+            self.errors += 1
+        self.latencies.setdefault(step, []).append(time.monotonic() - due)
+
+    async def _run(self, scenario: str, due: float):
+        if scenario == "start":
+            await self._feed("start", self.api.message_update(next(self.user_ids)), due)
+        elif scenario == "download":
+            user_id = FIRST_USER_ID + random.randrange(max(1, next(self.user_ids) - FIRST_USER_ID))
+            await self._feed("download", self.api.callback_update(user_id, "download_file"), due)
+        else:
+            # One conversation per admin at a time, as with a real person
+            admin_id = await self.admins.get()
+            try:
+                await self._feed("admin_menu", self.api.message_update(admin_id, "/admin"), due)
+                await self._feed("admin_callback", self.api.callback_update(admin_id, "admin_edit_caption"),
+                                 time.monotonic())
+                await self._feed("admin_text", self.api.message_update(admin_id, f"Caption {next(self.captions)}"),
+                                 time.monotonic())
+            finally:
+                self.admins.put_nowait(admin_id)
+
+    async def run(self, rate: float, seconds: float) -> Dict:
+        """Start scenarios at `rate` per second for `seconds`, then wait for all of them to finish"""
+        self.latencies = {}
+        self.errors = 0
+        tasks = []
+        start = time.monotonic()
+        for i in itertools.count():
+            due = start + i / rate
+            if due - start >= seconds:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            scenario = random.choices(self.scenarios, self.weights)[0]
+            tasks.append(asyncio.create_task(self._run(scenario, due)))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start
+        return {
+            "target_rate": rate,
+            "achieved_rate": len(tasks) / elapsed,
+            "scenarios": len(tasks),
+            "errors": self.errors,
+            "handlers": {step: summarize_latencies(values) for step, values in self.latencies.items()},
+        }
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ("start", "download", "admin"):
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+async def run(args) -> Dict:
+    api = FakeBotAPI(latency=args.api_latency_ms / 1000)
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = import_bot(tmp)
+        # A file to send, so downloads exercise the document reply
+        bot.db.add_file("BQACAgIAAxkBAAIBench", "document", "app.apk")
+        bot.payloads.file.rebuild()
+
+        app = bot.build_application(request=InMemoryRequest(api))
+        await app.initialize()
+        await app.update_processor.initialize()
+        bot.registrations.start()
+        generator = LoadGenerator(app, api, args.mix)
+
+        steps = []
+        for rate in args.rates:
+            monitor = EventLoopLagMonitor(interval=0.01, report_every=0)
+            monitor.start()
+            if args.memory:
+                tracemalloc.reset_peak()
+            result = await generator.run(rate, args.seconds)
+            monitor.stop()
+            lag = monitor.snapshot()
+            result["loop_lag_avg_ms"] = lag["avg_lag"] * 1000
+            result["loop_lag_max_ms"] = lag["max_lag"] * 1000
+            if args.memory:
+                result["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            worst_p99 = max(stats["p99_ms"] for stats in result["handlers"].values())
+            result["behind"] = result["achieved_rate"] < rate * 0.95 or worst_p99 > args.slo_ms
+            steps.append(result)
+            if result["behind"] and not args.all_rates:
+                break
+
+        # Write the buffered /start registrations, as shutdown would
+        await bot.registrations.stop()
+        await app.update_processor.shutdown()
+        await app.shutdown()
+        bot.adb.close()
+
+    sustained = [step["target_rate"] for step in steps if not step["behind"]]
+    return {
+        "mix": args.mix,
+        "api_latency_ms": args.api_latency_ms,
+        "slo_ms": args.slo_ms,
+        "max_sustained_rate": max(sustained) if sustained else None,
+        "steps": steps,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rates", default="50,100,200,400,800",
+                        type=lambda text: [float(rate) for rate in text.split(",")],
+                        help="comma-separated scenarios per second, tried in order")
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of each rate")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("start=70,download=25,admin=5"),
+                        help="scenario weights, e.g. start=70,download=25,admin=5")
+    parser.add_argument("--api-latency-ms", type=float, default=20.0, help="simulated Bot API round trip")
+    parser.add_argument("--slo-ms", type=float, default=1000.0,
+                        help="a rate counts as sustained while every handler's p99 stays below this")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip tracemalloc, which slows Python code down noticeably")
+    parser.add_argument("--all-rates", action="store_true", help="keep going after the bot falls behind")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    os.environ["ADMIN_IDS"] = ",".join(str(admin_id) for admin_id in ADMIN_IDS)
+    os.environ["METRICS_PORT"] = "0"
+    # Downloads come from random earlier users; measure the full reply, not the anti-flood guard
+    os.environ["REQUEST_DEBOUNCE_SECONDS"] = "0"
+    os.environ["USER_REQUESTS_PER_MINUTE"] = "0"
+    logging.basicConfig(level=logging.WARNING)
+    logging.disable(logging.INFO)
+    if args.memory:
+        tracemalloc.start()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for step in results["steps"]:
+        memory = f", peak {step['traced_peak_mb']:.1f} MB traced" if "traced_peak_mb" in step else ""
+        print(
+            f"target {step['target_rate']:.0f}/s -> achieved {step['achieved_rate']:.0f}/s, "
+            f"loop lag avg {step['loop_lag_avg_ms']:.1f} ms max {step['loop_lag_max_ms']:.1f} ms{memory}, "
+            f"{step['errors']} errors"
+            f"{'  BEHIND' if step['behind'] else ''}"
+        )
+        for name, stats in step["handlers"].items():
+            print(f"    {name:<16}{stats['count']:>7} updates  p50 {stats['p50_ms']:>8.1f} ms  "
+                  f"p99 {stats['p99_ms']:>8.1f} ms")
+    print(f"max sustained rate: {results['max_sustained_rate']}")
+
+
+if __name__ == "__main__":
+    main()
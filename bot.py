@@ -1,107 +1,131 @@
 import logging
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from typing import List, Optional
+from telegram import Update
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from telegram.error import TelegramError
+from telegram.request import BaseRequest
 
-from config import BOT_TOKEN, ADMIN_IDS
-from db import Database
+from config import (
+    BOT_TOKEN, ADMIN_IDS, BROADCAST_RATE_LIMIT, PER_CHAT_RATE_LIMIT, BROADCAST_CONCURRENCY,
+    BROADCAST_BATCH_SIZE, SEND_MAX_ATTEMPTS, SEND_RETRY_BASE_DELAY, SEND_RETRY_MAX_DELAY,
+    LOOP_LAG_REPORT_INTERVAL, REGISTRATION_FLUSH_INTERVAL, REGISTRATION_FLUSH_ROWS,
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN,
+    UPDATE_CONCURRENCY, BULK_CONNECTION_POOL_SIZE, BULK_REQUEST_TIMEOUT,
+    AUTO_MESSAGE_TICK_SECONDS, SENDER_WORKERS, SENDER_BOT_TOKENS, METRICS_LISTEN, METRICS_PORT,
+    PROFILING_ENABLED, SLOW_LOG_THRESHOLD_MS, PROFILE_CAPTURE_SECONDS, PROFILE_DIR,
+    LOG_RATE_LIMIT, LOG_SAMPLE_RATES, REQUEST_DEBOUNCE_SECONDS, USER_REQUESTS_PER_MINUTE,
+    REQUEST_GUARD_MAX_USERS
+)
+from db import Database, AsyncDatabase, UserRegistrationBuffer
+from delivery import (
+    RateLimiter, RetryPolicy, DeliveryEngine, InteractiveRateLimiter, Sender, SenderPool, PooledDeliveryEngine
+)
+from broadcast import BroadcastManager, build_bulk_bot
+from payloads import ReplyPayloads, MediaMirror
 from admin import AdminPanel
 from scheduler import MessageScheduler
+from monitoring import EventLoopLagMonitor
+from metrics import InstrumentedRequest, MetricsServer, timed_handler
+from profiling import PROFILER
+from log_setup import setup_logging, parse_sample_rates
+from request_guard import RequestGuard, REASON_DUPLICATE
+from sender_worker import SenderWorkerPool
+from update_processor import PerChatUpdateProcessor
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+# Configure logging: records are written by a background thread, never on the event loop
+setup_logging(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO,
+    rate=LOG_RATE_LIMIT,
+    sample_rates=parse_sample_rates(LOG_SAMPLE_RATES)
 )
 logger = logging.getLogger(__name__)
 
+PROFILER.configure(PROFILING_ENABLED, SLOW_LOG_THRESHOLD_MS / 1000, PROFILE_CAPTURE_SECONDS, PROFILE_DIR)
+
 # Initialize components
 db = Database()
-admin_panel = AdminPanel(db, ADMIN_IDS)
+# Handlers and the scheduler await queries through this so SQLite never blocks the event loop
+adb = AsyncDatabase(db)
+registrations = UserRegistrationBuffer(
+    adb, flush_interval=REGISTRATION_FLUSH_INTERVAL, max_rows=REGISTRATION_FLUSH_ROWS
+)
+retry_policy = RetryPolicy(SEND_MAX_ATTEMPTS, SEND_RETRY_BASE_DELAY, SEND_RETRY_MAX_DELAY)
+delivery_engine = DeliveryEngine(
+    RateLimiter(BROADCAST_RATE_LIMIT, PER_CHAT_RATE_LIMIT),
+    concurrency=BROADCAST_CONCURRENCY,
+    retry_policy=retry_policy
+)
+# Every bot token has its own budget; index 0 is the main bot, then SENDER_BOT_TOKENS in order
+sender_rate_limiters = [delivery_engine.rate_limiter] + [
+    RateLimiter(BROADCAST_RATE_LIMIT, PER_CHAT_RATE_LIMIT) for _ in SENDER_BOT_TOKENS
+]
+# Re-uploads the main bot's media for the other sender bots
+media_mirror = MediaMirror(senders=len(SENDER_BOT_TOKENS))
+broadcasts = BroadcastManager(
+    adb, delivery_engine, batch_size=BROADCAST_BATCH_SIZE, shards=SENDER_WORKERS, mirror=media_mirror
+)
+payloads = ReplyPayloads(db, media_mirror)
+# Drops repeated /start and download taps before they cost a send from the shared budget
+request_guard = RequestGuard(REQUEST_DEBOUNCE_SECONDS, USER_REQUESTS_PER_MINUTE, max_users=REQUEST_GUARD_MAX_USERS)
+admin_panel = AdminPanel(adb, ADMIN_IDS, broadcasts, payloads)
 scheduler = None  # Will be initialized after bot is created
+bulk_bot = None  # Bot used for broadcasts, created with the application
+sender_pool = None  # Sender worker processes, when SENDER_WORKERS > 0
+senders: List[Sender] = []  # Bulk Bot and rate limiter of every bot token
+sender_apps: List[Application] = []  # Answer /start and downloads on the SENDER_BOT_TOKENS bots
+loop_lag_monitor = EventLoopLagMonitor(report_every=LOOP_LAG_REPORT_INTERVAL)
+metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT)
 
 
+@timed_handler("start")
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     user = update.effective_user
+    # Which bot the user started: 0 for the main bot, 1.. for SENDER_BOT_TOKENS
+    sender_index = context.bot_data.get("sender_index", 0)
+    if request_guard.suppressed(user.id, "start", sender_index):
+        return
     
     try:
-        # Add user to database
-        db.add_user(
+        # Queue the user for the next batched database write
+        registrations.add(
             user_id=user.id,
             username=user.username,
-            first_name=user.first_name
+            first_name=user.first_name,
+            sender_index=sender_index
         )
         
-        # Get settings
-        channel_link = db.get_setting("channel_link")
-        button_text = db.get_setting("button_text") or "Join Big Mumbai Channel"
-        file_button_text = db.get_setting("file_button_text") or "📥 Download Files"
-        caption_text = db.get_setting("caption_text") or "Welcome to Big Mumbai Official!"
-        image_file_id = db.get_setting("image_file_id")
-        
-        # Create inline buttons - channel link and file download
-        keyboard = [
-            [InlineKeyboardButton(button_text, url=channel_link)],
-            [InlineKeyboardButton(file_button_text, callback_data="download_file")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Send photo if available, otherwise send text
-        if image_file_id:
-            try:
-                await update.message.reply_photo(
-                    photo=image_file_id,
-                    caption=caption_text,
-                    reply_markup=reply_markup
-                )
-            except TelegramError as e:
-                logger.warning(f"Failed to send photo, falling back to text: {e}")
-                await update.message.reply_text(
-                    text=caption_text,
-                    reply_markup=reply_markup
-                )
-        else:
-            await update.message.reply_text(
-                text=caption_text,
-                reply_markup=reply_markup
-            )
+        # Send the prebuilt welcome photo/text with its buttons
+        await payloads.welcome.send(update.message, sender_index)
             
-        logger.info(f"User {user.id} started the bot")
+        logger.debug(f"User {user.id} started the bot")
         
     except Exception as e:
         logger.error(f"Error in start_command: {e}", exc_info=True)
         await update.message.reply_text("❌ An error occurred. Please try again later.")
 
 
+@timed_handler("download")
 async def download_file_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle file download button click"""
     query = update.callback_query
+    sender_index = context.bot_data.get("sender_index", 0)
+    reason = request_guard.suppressed(query.from_user.id, "download", sender_index)
+    if reason:
+        # Still answer, or the button keeps spinning
+        if reason == REASON_DUPLICATE:
+            await query.answer("⏳ Your files are on the way.")
+        else:
+            await query.answer("⏳ Too many requests, please try again shortly.")
+        return
     await query.answer()
     
     try:
-        # Get file information from database
-        file_type = db.get_setting("file_type")  # 'document', 'photo', 'video', etc.
-        file_id = db.get_setting("file_id")
-        file_caption = db.get_setting("file_caption") or "📥 Here's your file!"
-        
-        if not file_id:
-            await query.message.reply_text("❌ No file available at the moment. Please check back later.")
-            return
+        # Send the file bundle with the calls prebuilt when it last changed
+        await payloads.file.send(query.message, sender_index)
         
-        # Send file based on type
-        if file_type == "photo":
-            await query.message.reply_photo(photo=file_id, caption=file_caption)
-        elif file_type == "video":
-            await query.message.reply_video(video=file_id, caption=file_caption)
-        elif file_type == "audio":
-            await query.message.reply_audio(audio=file_id, caption=file_caption)
-        else:
-            # Default to document (APK, PDF, etc.)
-            await query.message.reply_document(document=file_id, caption=file_caption)
-        
-        logger.info(f"File sent to user {query.from_user.id}")
+        logger.debug(f"File sent to user {query.from_user.id}")
         
     except Exception as e:
         logger.error(f"Error sending file: {e}", exc_info=True)
@@ -120,54 +144,179 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Exception while handling an update: {context.error}", exc_info=context.error)
 
 
-def main():
-    """Main function to start the bot"""
-    global scheduler
-    
-    # Fix for Python 3.14: Create event loop explicitly
-    import sys
-    if sys.platform == 'win32':
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+# Only the update types our handlers use: commands/admin replies and inline buttons
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+# PTB's default pool size for the reply connections
+REPLY_CONNECTION_POOL_SIZE = 256
+
+
+def build_sender_application(index: int, token: str, base_url: Optional[str] = None) -> Application:
+    """Create the Application that answers /start and downloads on extra sender bot `index`"""
+    builder = Application.builder().token(token)
+    # Times every Bot API call the handlers make
+    builder = builder.request(InstrumentedRequest(connection_pool_size=REPLY_CONNECTION_POOL_SIZE))
+    if base_url:
+        builder = builder.base_url(base_url)
+    if UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(UPDATE_CONCURRENCY))
+    builder = builder.rate_limiter(InteractiveRateLimiter(sender_rate_limiters[index]))
+    application = builder.build()
+    application.bot_data["sender_index"] = index
     
-    # Create and set event loop for Python 3.14 compatibility
-    try:
-        loop = asyncio.get_event_loop()
-        if loop.is_closed():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-    except RuntimeError:
-        # No event loop exists (Python 3.14 behavior)
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CallbackQueryHandler(download_file_callback, pattern="^download_file$"))
+    application.add_error_handler(error_handler)
+    if PROFILING_ENABLED:
+        PROFILER.instrument_application(application)
+    return application
+
+
+def build_application(token: str = BOT_TOKEN, base_url: Optional[str] = None,
+                      request: Optional[BaseRequest] = None) -> Application:
+    """Create the Application with all handlers, the scheduler and lifecycle hooks
+
+    `request` replaces the HTTP client of the reply bot, e.g. with an in-memory fake for load tests.
+    """
+    global scheduler, bulk_bot, sender_pool
     
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = Application.builder().token(token)
+    # Times every Bot API call the handlers make
+    builder = builder.request(request or InstrumentedRequest(connection_pool_size=REPLY_CONNECTION_POOL_SIZE))
+    if base_url:
+        builder = builder.base_url(base_url)
+    if UPDATE_CONCURRENCY > 1:
+        # Different users are served in parallel; each user's own updates stay in order
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(UPDATE_CONCURRENCY))
+    # Replies to users skip ahead of queued broadcast sends in the shared msgs/sec budget
+    builder = builder.rate_limiter(InteractiveRateLimiter(delivery_engine.rate_limiter))
+    application = builder.build()
+    
+    # Broadcasts get a separate Bot so bulk sends never occupy the reply connections
+    bulk_bot = build_bulk_bot(token, base_url, BULK_CONNECTION_POOL_SIZE, BULK_REQUEST_TIMEOUT)
+    admin_panel.bulk_bot = bulk_bot
+    media_mirror.source_bot = bulk_bot
+    
+    # Extra sender tokens: broadcasts are spread over all bots, each within its own rate limit
+    senders[:] = [Sender(0, bulk_bot, sender_rate_limiters[0])]
+    sender_apps.clear()
+    for index, sender_token in enumerate(SENDER_BOT_TOKENS, start=1):
+        sender_bot = build_bulk_bot(sender_token, base_url, BULK_CONNECTION_POOL_SIZE, BULK_REQUEST_TIMEOUT)
+        senders.append(Sender(index, sender_bot, sender_rate_limiters[index]))
+        sender_apps.append(build_sender_application(index, sender_token, base_url))
+    if len(senders) > 1:
+        broadcasts.delivery = PooledDeliveryEngine(SenderPool(senders), BROADCAST_CONCURRENCY, retry_policy)
+    if SENDER_WORKERS:
+        sender_pool = SenderWorkerPool(SENDER_WORKERS, base_url)
     
     # Add handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CallbackQueryHandler(download_file_callback, pattern="^download_file$"))
     application.add_handler(admin_panel.get_conversation_handler())
+    application.add_handler(admin_panel.get_album_handler())
     
     # Add error handler
     application.add_error_handler(error_handler)
     
+    if PROFILING_ENABLED:
+        # Time every handler by phase and log the slow ones
+        PROFILER.instrument_application(application)
+    
     # Initialize scheduler
-    scheduler = MessageScheduler(db, application.bot)
+    scheduler = MessageScheduler(adb, bulk_bot, broadcasts, tick_seconds=AUTO_MESSAGE_TICK_SECONDS)
     
     # Start scheduler
     async def post_init(app: Application):
         """Initialize after bot is ready"""
+        registrations.start()
+        for sender in senders:
+            await sender.bot.initialize()
+        for sender_app in sender_apps:
+            await sender_app.initialize()
+            await sender_app.start()
+            await sender_app.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        
         # Create task in the current event loop
         scheduler.task = asyncio.create_task(scheduler.scheduler_loop())
         logger.info("Scheduler started")
+        
+        if sender_pool:
+            # Claims held by workers of the previous run are void; the new workers pick them up
+            await adb.release_broadcast_shards()
+            sender_pool.start()
+        
+        # Pick up broadcasts interrupted by the last shutdown from their saved cursor
+        await broadcasts.resume_unfinished(bulk_bot)
+        
+        if LOOP_LAG_REPORT_INTERVAL:
+            loop_lag_monitor.start()
+        
+        if METRICS_PORT:
+            await metrics_server.start()
+    
+    async def post_shutdown(app: Application):
+        """Release resources after the bot has stopped"""
+        scheduler.stop()
+        # Stop sending before the bots close and save progress while the database is open
+        await broadcasts.stop()
+        loop_lag_monitor.stop()
+        await metrics_server.stop()
+        if sender_pool:
+            await sender_pool.stop()
+        for sender_app in sender_apps:
+            if sender_app.updater.running:
+                await sender_app.updater.stop()
+            if sender_app.running:
+                await sender_app.stop()
+            await sender_app.shutdown()
+        for sender in senders:
+            await sender.bot.shutdown()
+        await registrations.stop()
+        adb.close()
     
-    # Start the bot
-    logger.info("Starting bot...")
     application.post_init = post_init
-    application.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None)
+    application.post_shutdown = post_shutdown
+    return application
+
+
+def main():
+    """Main function to start the bot"""
+    # Fix for Python 3.14: Create event loop explicitly
+    import sys
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    
+    # Create and set event loop for Python 3.14 compatibility
+    try:
+        loop = asyncio.get_event_loop()
+        if loop.is_closed():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+    except RuntimeError:
+        # No event loop exists (Python 3.14 behavior)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    
+    application = build_application()
+    
+    # Start the bot
+    if WEBHOOK_URL:
+        logger.info(f"Starting bot in webhook mode on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            # Telegram sends this in X-Telegram-Bot-Api-Secret-Token; other requests get 403
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            allowed_updates=ALLOWED_UPDATES,
+            stop_signals=None
+        )
+    else:
+        logger.info("Starting bot...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES, stop_signals=None)
 
 
 if __name__ == "__main__":
     main()
-
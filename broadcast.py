@@ -0,0 +1,424 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple, Union
+from telegram import Bot
+from telegram.error import TelegramError
+from db import AsyncDatabase
+from delivery import DeliveryEngine, PooledDeliveryEngine, Sender, is_blocked_error
+from metrics import DELIVERY_DEGRADED, InstrumentedRequest
+from payloads import MediaMirror, send_media
+
+logger = logging.getLogger(__name__)
+
+# Job kinds
+JOB_AUTO = "auto"
+JOB_BROADCAST = "broadcast"
+
+
+class ShardClaimLost(Exception):
+    """Another sender worker took over the shard; this one must stop sending it"""
+
+
+class DeliveryResults:
+    """Collects per-recipient outcomes of a job and writes them in bulk at checkpoints
+
+    Recipients are dispatched in user_id order but finish out of order, so an outcome is
+    only released for writing once every earlier recipient has finished too. The job
+    cursor therefore never moves past a user whose delivery is still in flight or waiting
+    for a retry.
+    """
+
+    SENT = "sent"
+    FAILED = "failed"
+    BLOCKED = "blocked"
+
+    def __init__(self, db: AsyncDatabase, job_id: int, cursor: int, update_last_sent: bool,
+                 chunk_size: int = 500, shard: Optional[int] = None, owner: Optional[str] = None):
+        self.db = db
+        self.job_id = job_id
+        self.shard = shard
+        # The sender worker holding the shard's claim
+        self.owner = owner
+        self.cursor = cursor
+        self.update_last_sent = update_last_sent
+        self.chunk_size = chunk_size
+        self._in_flight: Deque[int] = deque()
+        self._finished: Dict[int, str] = {}
+        self._lock = asyncio.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.success = 0
+        self.failed = 0
+        self.sent: List[int] = []
+        self.blocked: List[int] = []
+        # Failure reasons since the last checkpoint, logged as one summary line instead of per user
+        self.errors: Counter = Counter()
+
+    @property
+    def pending(self) -> int:
+        """Outcomes released but not yet checkpointed"""
+        return self.success + self.failed
+
+    def dispatched(self, chat_id: int):
+        self._in_flight.append(chat_id)
+
+    def record_sent(self, chat_id: int):
+        self._finish(chat_id, self.SENT)
+
+    def record_failed(self, chat_id: int, blocked: bool, error: Optional[Exception] = None):
+        if error is not None:
+            self.errors[f"{type(error).__name__}: {error}"[:120]] += 1
+        self._finish(chat_id, self.BLOCKED if blocked else self.FAILED)
+
+    def _finish(self, chat_id: int, outcome: str):
+        self._finished[chat_id] = outcome
+        # Release the contiguous run of finished recipients at the head of the queue
+        while self._in_flight and self._in_flight[0] in self._finished:
+            user_id = self._in_flight.popleft()
+            outcome = self._finished.pop(user_id)
+            self.cursor = user_id
+            if outcome == self.SENT:
+                self.success += 1
+                if self.update_last_sent:
+                    self.sent.append(user_id)
+            else:
+                self.failed += 1
+                if outcome == self.BLOCKED:
+                    self.blocked.append(user_id)
+
+    async def checkpoint(self, min_pending: int = 1) -> bool:
+        """Write released outcomes in chunked transactions, then advance the job cursor"""
+        async with self._lock:
+            if self.pending < min_pending:
+                return False
+            sent, blocked, success, failed, cursor = self.sent, self.blocked, self.success, self.failed, self.cursor
+            errors = self.errors
+            # Outcomes released while the writes below are awaited collect in fresh buffers
+            self._reset()
+            write = asyncio.ensure_future(self._write(sent, blocked, cursor, success, failed))
+            try:
+                await asyncio.shield(write)
+            except BaseException:
+                # Cancelled (shutdown): finish the batch anyway, a half-written one would be counted twice
+                await asyncio.wait([write])
+                if write.exception() is not None:
+                    # Put the batch back so the next checkpoint writes it; the outcome writes are idempotent
+                    self.sent = sent + self.sent
+                    self.blocked = blocked + self.blocked
+                    self.success += success
+                    self.failed += failed
+                    self.errors.update(errors)
+                raise
+
+            where = f"job {self.job_id}" if self.shard is None else f"job {self.job_id} shard {self.shard}"
+            summary = f"Broadcast {where}: {success} sent, {failed} failed ({len(blocked)} blocked) up to user {cursor}"
+            if errors:
+                summary += "; errors: " + ", ".join(f"{reason} x{count}" for reason, count in errors.most_common(5))
+            logger.info(summary)
+            return True
+
+    async def _write(self, sent: List[int], blocked: List[int], cursor: int, success: int, failed: int):
+        # Outcomes go first: a crash before the cursor moves re-sends, never loses them
+        if sent:
+            await self.db.update_last_message_sent_many(sent, self.chunk_size)
+        if blocked:
+            await self.db.mark_users_inactive_many(blocked, self.chunk_size)
+        if self.shard is None:
+            await self.db.checkpoint_broadcast_job(self.job_id, cursor, success, failed)
+        elif not await self.db.checkpoint_broadcast_shard(
+            self.job_id, self.shard, cursor, success, failed, self.owner
+        ):
+            raise ShardClaimLost(f"Job {self.job_id} shard {self.shard} was taken over by another worker")
+
+
+def build_bulk_bot(token: str, base_url: Optional[str] = None, connection_pool_size: int = 24,
+                   timeout: float = 20.0) -> Bot:
+    """Create a Bot for broadcast traffic, with its own connection pool and timeouts"""
+    request = InstrumentedRequest(
+        connection_pool_size=connection_pool_size,
+        read_timeout=timeout,
+        write_timeout=timeout,
+        pool_timeout=timeout
+    )
+    if base_url:
+        return Bot(token, base_url=base_url, request=request)
+    return Bot(token, request=request)
+
+
+class BroadcastManager:
+    """Runs broadcast jobs stored in SQLite, checkpointing after every batch
+
+    With shards > 0, new jobs are split into that many user_id ranges which sender worker
+    processes deliver (see sender_worker.py); this process then only waits for the job to
+    finish.
+    """
+
+    # Seconds between progress checks of a job delivered by sender workers
+    SHARDED_POLL_INTERVAL = 5
+
+    def __init__(self, db: AsyncDatabase, delivery: Union[DeliveryEngine, PooledDeliveryEngine],
+                 batch_size: int = 500, shards: int = 0, mirror: Optional[MediaMirror] = None):
+        self.db = db
+        # A PooledDeliveryEngine spreads recipients over several sender bots
+        self.delivery = delivery
+        self.mirror = mirror or MediaMirror()
+        self.batch_size = batch_size
+        self.shards = shards
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def create_job(self, kind: str, text: Optional[str], photo: Optional[str] = None,
+                         status_chat_id: Optional[int] = None, status_message_id: Optional[int] = None,
+                         from_chat_id: Optional[int] = None, message_ids: Optional[List[int]] = None,
+                         media: Optional[List[Dict]] = None, parse_mode: Optional[str] = None) -> int:
+        """Create a job for the current active audience
+
+        With from_chat_id and message_ids, the main bot copies those messages to every user
+        (copy_message, or copy_messages for an album). The other sender bots cannot read the
+        admin's chat with the main bot: they send the files in media (see send_media) if
+        given, and otherwise only text and photo. parse_mode applies to text and captions.
+        """
+        payload = {
+            "text": text,
+            "photo": photo,
+            "status_chat_id": status_chat_id,
+            "status_message_id": status_message_id,
+            "parse_mode": parse_mode,
+        }
+        if message_ids:
+            payload["from_chat_id"] = from_chat_id
+            payload["message_ids"] = sorted(message_ids)
+            payload["media"] = media
+        return await self.db.create_broadcast_job(kind, payload, self.shards)
+
+    async def create_auto_job(self, text: str, interval_seconds: int) -> int:
+        """Create an auto-message job for every active user and schedule their next one"""
+        payload = {"text": text, "photo": None, "status_chat_id": None, "status_message_id": None}
+        return await self.db.create_broadcast_job(
+            JOB_AUTO, payload, self.shards, now=int(time.time()), interval_seconds=interval_seconds
+        )
+
+    async def create_due_auto_job(self, text: str, interval_seconds: int) -> Optional[int]:
+        """Create an auto-message job for the users whose next message is due, or None if nobody is"""
+        payload = {"text": text, "photo": None, "status_chat_id": None, "status_message_id": None}
+        return await self.db.create_due_broadcast_job(
+            JOB_AUTO, payload, int(time.time()), interval_seconds, self.shards
+        )
+
+    def start_job(self, job_id: int, bot: Bot) -> asyncio.Task:
+        """Run a job in the background, reusing the task if it is already running"""
+        task = self._tasks.get(job_id)
+        if task is None or task.done():
+            task = asyncio.create_task(self.run_job(job_id, bot))
+            self._tasks[job_id] = task
+            task.add_done_callback(lambda t: self._job_done(job_id, t))
+        return task
+
+    async def stop(self):
+        """Cancel the running jobs once their progress is saved; they resume on the next start"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _job_done(self, job_id: int, task: asyncio.Task):
+        if self._tasks.get(job_id) is task:
+            del self._tasks[job_id]
+        if not task.cancelled() and task.exception() is not None:
+            # The job stays unfinished and is started again from its last checkpoint later
+            logger.error(f"Broadcast job {job_id} failed: {task.exception()}", exc_info=task.exception())
+
+    async def resume_unfinished(self, bot: Bot):
+        """Restart every job that was interrupted by a restart"""
+        for job in await self.db.get_unfinished_broadcast_jobs():
+            logger.info(
+                f"Resuming broadcast job {job['job_id']} ({job['kind']}) "
+                f"after user {job['cursor']}: {job['success'] + job['failed']}/{job['total']} done"
+            )
+            self.start_job(job["job_id"], bot)
+
+    async def _send(self, bot: Bot, payload: Dict, chat_id: int, sender_index: int = 0):
+        message_ids = payload.get("message_ids")
+        if message_ids and sender_index == 0:
+            # One call per user whatever the message holds; media and formatting are kept
+            if len(message_ids) == 1:
+                await bot.copy_message(chat_id=chat_id, from_chat_id=payload["from_chat_id"], message_id=message_ids[0])
+            else:
+                await bot.copy_messages(chat_id=chat_id, from_chat_id=payload["from_chat_id"], message_ids=message_ids)
+            return
+
+        media = payload.get("media")
+        if media:
+            # The same files, re-uploaded to this bot once by the mirror
+            await send_media(bot, chat_id, media, self.mirror, sender_index, payload.get("parse_mode"))
+            return
+
+        photo = payload.get("photo")
+        if photo:
+            await self.mirror.send(sender_index, [(photo, None)], lambda media: bot.send_photo(
+                chat_id=chat_id, photo=media[0], caption=payload.get("text"), parse_mode=payload.get("parse_mode")
+            ))
+        elif payload.get("text"):
+            await bot.send_message(chat_id=chat_id, text=payload["text"], parse_mode=payload.get("parse_mode"))
+        else:
+            raise TelegramError("Only the main bot can copy this message")
+        if message_ids and media is None:
+            DELIVERY_DEGRADED.inc()
+
+    async def _report(self, bot: Bot, job: Dict, text: str):
+        """Edit the admin's status message, if the job has one"""
+        payload = job["payload"]
+        if not payload.get("status_message_id"):
+            return
+        try:
+            await bot.edit_message_text(
+                text,
+                chat_id=payload["status_chat_id"],
+                message_id=payload["status_message_id"]
+            )
+        except TelegramError as e:
+            logger.warning(f"Failed to update status for broadcast job {job['job_id']}: {e}")
+
+    async def _deliver(self, bot: Bot, job: Dict, results: DeliveryResults, last_user_id: Optional[int] = None):
+        """Send the job payload to its targets after results.cursor, up to last_user_id"""
+        job_id = job["job_id"]
+        payload = job["payload"]
+        copy = bool(payload.get("message_ids"))
+        if copy and payload.get("media") is None and isinstance(self.delivery, PooledDeliveryEngine):
+            logger.warning(
+                f"Broadcast job {job_id}: users who only started a sender bot get its text or photo only"
+            )
+
+        async def targets() -> AsyncIterator[int]:
+            # Stream the audience lazily, one keyset page ahead of the workers
+            async for user_id in self.db.iter_broadcast_targets(
+                job_id, results.cursor, self.batch_size, last_user_id
+            ):
+                results.dispatched(user_id)
+                yield user_id
+
+        async def recipients() -> AsyncIterator[Tuple[int, int]]:
+            # Same order as targets(), with the bots each user started for choosing a sender
+            async for user_id, bot_mask in self.db.iter_broadcast_recipients(
+                job_id, results.cursor, self.batch_size, last_user_id
+            ):
+                results.dispatched(user_id)
+                if copy and bot_mask & 1:
+                    # Only the main bot can copy the admin's message, so keep its users on it
+                    bot_mask = 1
+                yield user_id, bot_mask
+
+        async def send(chat_id: int):
+            await self._send(bot, payload, chat_id)
+
+        async def send_via(sender: Sender, chat_id: int):
+            await self._send(sender.bot, payload, chat_id, sender.index)
+
+        async def checkpoint(min_pending: int):
+            try:
+                written = await results.checkpoint(min_pending)
+            except Exception as e:
+                # Stop sending rather than run ahead of outcomes that cannot be saved; the
+                # engine would only log the error and carry on
+                if not failures:
+                    failures.append(e)
+                    delivery.cancel()
+                return
+            if written:
+                progress = await self.db.get_broadcast_job(job_id)
+                await self._report(
+                    bot, progress,
+                    f"📢 Broadcasting... {progress['success'] + progress['failed']}/{progress['total']}\n"
+                    f"✅ Success: {progress['success']}\n❌ Failed: {progress['failed']}"
+                )
+
+        async def on_sent(chat_id: int):
+            results.record_sent(chat_id)
+            await checkpoint(self.batch_size)
+
+        async def on_failed(chat_id: int, error: Exception):
+            # Blocked the bot, deleted the account or the chat no longer exists
+            results.record_failed(chat_id, blocked=is_blocked_error(error), error=error)
+            await checkpoint(self.batch_size)
+
+        failures: List[Exception] = []
+        if isinstance(self.delivery, PooledDeliveryEngine):
+            delivery = asyncio.ensure_future(
+                self.delivery.broadcast(recipients(), send_via, on_sent=on_sent, on_failed=on_failed)
+            )
+        else:
+            delivery = asyncio.ensure_future(
+                self.delivery.broadcast(targets(), send, on_sent=on_sent, on_failed=on_failed)
+            )
+        try:
+            await delivery
+        except asyncio.CancelledError:
+            if not failures:
+                # Shutting down: save what was delivered so the job resumes after it
+                await results.checkpoint()
+                raise
+        if failures:
+            logger.error(f"Stopped broadcast job {job_id} after a failed checkpoint: {failures[0]}")
+            raise failures[0]
+        await results.checkpoint()
+
+    async def _report_completed(self, bot: Bot, job_id: int) -> Dict:
+        job = await self.db.get_broadcast_job(job_id)
+        logger.info(f"Broadcast job {job_id} completed: {job['success']} success, {job['failed']} failed")
+        await self._report(
+            bot, job,
+            f"📢 Broadcast completed!\n✅ Success: {job['success']}\n❌ Failed: {job['failed']}"
+        )
+        return job
+
+    async def run_job(self, job_id: int, bot: Bot) -> Optional[Dict]:
+        """Deliver a job from its saved cursor and return the final job row"""
+        job = await self.db.get_broadcast_job(job_id)
+        if not job or job["status"] != "running":
+            return job
+
+        if job["shards"] and not self.shards:
+            # Split for sender workers that are no longer configured; send the ranges from here
+            await self.db.release_broadcast_shards()
+            for shard in range(job["shards"]):
+                await self.run_shard(job_id, shard, bot)
+            return await self.db.get_broadcast_job(job_id)
+
+        if job["shards"]:
+            # Sender workers deliver the shards and report progress; just wait for them
+            while job["status"] == "running":
+                await asyncio.sleep(self.SHARDED_POLL_INTERVAL)
+                job = await self.db.get_broadcast_job(job_id)
+            return job
+
+        # Outcomes are buffered and written once per batch rather than once per recipient
+        results = DeliveryResults(
+            self.db, job_id, job["cursor"], update_last_sent=job["kind"] == JOB_AUTO, chunk_size=self.batch_size
+        )
+        await self._deliver(bot, job, results)
+
+        await self.db.finish_broadcast_job(job_id)
+        return await self._report_completed(bot, job_id)
+
+    async def run_shard(self, job_id: int, shard: int, bot: Bot, owner: Optional[str] = None):
+        """Deliver one user_id range of a sharded job from its saved cursor
+
+        owner is the sender worker holding the shard's claim. If another worker takes the
+        claim over, ShardClaimLost is raised at the next checkpoint.
+        """
+        job = await self.db.get_broadcast_job(job_id)
+        shard_row = await self.db.get_broadcast_shard(job_id, shard)
+        if not job or not shard_row or shard_row["status"] != "running":
+            return
+
+        results = DeliveryResults(
+            self.db, job_id, shard_row["cursor"], update_last_sent=job["kind"] == JOB_AUTO,
+            chunk_size=self.batch_size, shard=shard, owner=owner
+        )
+        await self._deliver(bot, job, results, last_user_id=shard_row["last_user_id"])
+
+        # Whichever worker finishes the last shard closes the job and tells the admin
+        if await self.db.finish_broadcast_shard(job_id, shard, owner):
+            await self._report_completed(bot, job_id)
@@ -17,3 +17,76 @@ DATABASE_PATH = "bot_database.db"
 DEFAULT_INTERVAL_HOURS = 8
 DEFAULT_AUTO_MESSAGES_ENABLED = True
 
+
+# Outbound delivery limits (Telegram allows roughly 30 msgs/sec per bot and 1 msg/sec per chat)
+BROADCAST_RATE_LIMIT = float(os.getenv("BROADCAST_RATE_LIMIT", "25"))
+PER_CHAT_RATE_LIMIT = float(os.getenv("PER_CHAT_RATE_LIMIT", "1"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))
+SEND_RETRY_BASE_DELAY = float(os.getenv("SEND_RETRY_BASE_DELAY", "1"))
+SEND_RETRY_MAX_DELAY = float(os.getenv("SEND_RETRY_MAX_DELAY", "30"))
+
+# Log event-loop lag statistics every N seconds (0 disables the monitor)
+LOOP_LAG_REPORT_INTERVAL = float(os.getenv("LOOP_LAG_REPORT_INTERVAL", "300"))
+
+# /start registrations are written in batches: every N seconds or once M users are waiting
+REGISTRATION_FLUSH_INTERVAL = int(os.getenv("REGISTRATION_FLUSH_INTERVAL_MS", "500")) / 1000
+REGISTRATION_FLUSH_ROWS = int(os.getenv("REGISTRATION_FLUSH_ROWS", "500"))
+
+# Webhook mode: set WEBHOOK_URL (public https base URL) to receive updates by webhook instead of polling.
+# The bot listens on WEBHOOK_LISTEN:WEBHOOK_PORT, usually behind a reverse proxy terminating TLS.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+
+if WEBHOOK_URL and not WEBHOOK_SECRET_TOKEN:
+    raise ValueError("WEBHOOK_SECRET_TOKEN must be set in .env file when WEBHOOK_URL is used.")
+
+# Updates handled in parallel (updates from the same user are still processed in order; 1 = sequential)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+# Broadcasts and auto messages use their own HTTP connection pool so user replies never queue behind them
+BULK_CONNECTION_POOL_SIZE = int(os.getenv("BULK_CONNECTION_POOL_SIZE", str(BROADCAST_CONCURRENCY + 4)))
+BULK_REQUEST_TIMEOUT = float(os.getenv("BULK_REQUEST_TIMEOUT", "20"))
+
+# How often the scheduler checks for due auto messages, in seconds
+AUTO_MESSAGE_TICK_SECONDS = float(os.getenv("AUTO_MESSAGE_TICK_SECONDS", "60"))
+
+# Broadcast sender processes: 0 sends from the bot process; N > 0 splits each job across N worker
+# processes (sender_worker.py) that share BROADCAST_RATE_LIMIT between them
+SENDER_WORKERS = int(os.getenv("SENDER_WORKERS", "0"))
+# Share of each bot token's BROADCAST_RATE_LIMIT that the sender workers split between them. Workers
+# cannot see the replies the bot process sends through the same token, so the rest is left free for
+# those replies (and their priority over bulk sends); keep it below 1.
+SENDER_WORKER_RATE_SHARE = min(1.0, max(0.05, float(os.getenv("SENDER_WORKER_RATE_SHARE", "0.8"))))
+
+# Extra bot tokens that share broadcast traffic, comma-separated. Each gets its own rate limit; users
+# are messaged through the bot(s) they started, so these bots also answer /start and downloads.
+SENDER_BOT_TOKENS = [token.strip() for token in os.getenv("SENDER_BOT_TOKENS", "").split(",") if token.strip()]
+
+# Prometheus-format metrics served at http://METRICS_LISTEN:METRICS_PORT/metrics (port 0 disables).
+# Sender worker N serves its own metrics on METRICS_PORT + 1 + N.
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Opt-in profiling: time handlers by phase (database, Bot API, other) and log anything slower than
+# SLOW_LOG_THRESHOLD_MS as JSON to the "slowlog" logger. Admin panel profile captures work either way.
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+SLOW_LOG_THRESHOLD_MS = float(os.getenv("SLOW_LOG_THRESHOLD_MS", "500"))
+PROFILE_CAPTURE_SECONDS = float(os.getenv("PROFILE_CAPTURE_SECONDS", "30"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Anti-flood for /start and the download button: repeats of the same request within
+# REQUEST_DEBOUNCE_SECONDS are dropped, and each user gets at most USER_REQUESTS_PER_MINUTE answers
+# (0 disables either). Up to REQUEST_GUARD_MAX_USERS recent users are tracked in memory.
+REQUEST_DEBOUNCE_SECONDS = float(os.getenv("REQUEST_DEBOUNCE_SECONDS", "3"))
+USER_REQUESTS_PER_MINUTE = float(os.getenv("USER_REQUESTS_PER_MINUTE", "20"))
+REQUEST_GUARD_MAX_USERS = int(os.getenv("REQUEST_GUARD_MAX_USERS", "100000"))
+
+# Logging: each log call site may write LOG_RATE_LIMIT lines per second (0 = unlimited); LOG_SAMPLE_RATES
+# keeps only a share of a logger's INFO/DEBUG lines, e.g. "bot=0.1,db=0.5"
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
@@ -1,104 +1,366 @@
 import sqlite3
 import logging
-from typing import Optional, List, Dict
+import json
+import threading
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Callable, Iterator, AsyncIterator, Tuple
 from contextlib import contextmanager
 
+from metrics import DB_QUERY_SECONDS, timed_methods
+from profiling import PROFILER
+
 logger = logging.getLogger(__name__)
 
 
+def _migration_initial_schema(cursor: sqlite3.Cursor):
+    """users and settings tables with default settings"""
+    # Users table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_message_sent TIMESTAMP
+        )
+    """)
+
+    # Settings table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+    # Initialize default settings
+    default_settings = {
+        "channel_link": "https://t.me/bigmumbaiofficial",
+        "button_text": "Join Big Mumbai Channel",
+        "file_button_text": "📥 Download Files",
+        "caption_text": "Welcome to Big Mumbai Official! Join our channel to stay updated.",
+        "image_file_id": None,
+        "file_id": None,
+        "file_type": None,
+        "file_name": None,
+        "file_caption": None,
+        "auto_message_text": "Don't forget to join our channel for latest updates!",
+        "interval_hours": "8",
+        "auto_messages_enabled": "1"
+    }
+
+    for key, value in default_settings.items():
+        cursor.execute(
+            "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+            (key, str(value) if value is not None else None)
+        )
+
+
+def _migration_broadcast_jobs(cursor: sqlite3.Cursor):
+    """broadcast_jobs and broadcast_targets tables"""
+    # Broadcast jobs: one row per auto-message batch or admin broadcast
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            success INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Audience snapshot for each unfinished job, walked in user_id order
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_targets (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+    """)
+
+
+def _migration_audience_indexes(cursor: sqlite3.Cursor):
+    """partial indexes for audience queries"""
+    # Keyset pages and job snapshots only ever look at active users
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(user_id) WHERE is_active = 1")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status, kind)")
+
+
+def _migration_user_counters(cursor: sqlite3.Cursor):
+    """trigger-maintained total/active user counters"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT OR REPLACE INTO user_counters (name, value) SELECT 'total', COUNT(*) FROM users")
+    cursor.execute("""
+        INSERT OR REPLACE INTO user_counters (name, value)
+        SELECT 'active', COUNT(*) FROM users WHERE is_active = 1
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_counters_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE user_counters SET value = value + 1 WHERE name = 'total';
+            UPDATE user_counters SET value = value + (NEW.is_active = 1) WHERE name = 'active';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_counters_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE user_counters SET value = value - 1 WHERE name = 'total';
+            UPDATE user_counters SET value = value - (OLD.is_active = 1) WHERE name = 'active';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_counters_active AFTER UPDATE OF is_active ON users
+        WHEN (OLD.is_active = 1) != (NEW.is_active = 1)
+        BEGIN
+            UPDATE user_counters SET value = value + (NEW.is_active = 1) - (OLD.is_active = 1)
+            WHERE name = 'active';
+        END
+    """)
+
+
+def _migration_null_settings(cursor: sqlite3.Cursor):
+    """store unset settings as NULL instead of the string 'None'"""
+    # Older versions saved str(None), which made an unset image/file look like a file_id
+    cursor.execute("UPDATE settings SET value = NULL WHERE value = 'None'")
+
+
+# Multiplier scattering user_ids over the seconds of an interval (a prime, so consecutive ids
+# land far apart instead of in consecutive seconds)
+_SLOT_MULTIPLIER = 1000003
+
+
+def _spread_due_sql(base: str) -> str:
+    """SQL for the first time at or after base that falls on the user's own second of the :interval
+
+    Each user is due at a fixed offset into every interval derived from user_id, so users
+    scheduled at the same moment (one batch job, one upgrade) are still due spread out.
+    """
+    slot = f"(abs(user_id) % :interval) * {_SLOT_MULTIPLIER} % :interval"
+    return f"({base}) + (({slot} - ({base})) % :interval + :interval) % :interval"
+
+
+def _migration_auto_message_schedule(cursor: sqlite3.Cursor):
+    """per-user next auto message time for spread delivery"""
+    # Unix time at which the user is due their next auto message; NULL until first scheduled
+    cursor.execute("ALTER TABLE users ADD COLUMN next_auto_message_at INTEGER")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_active_next_auto
+        ON users(next_auto_message_at) WHERE is_active = 1
+    """)
+    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('auto_message_mode', 'spread')")
+
+    row = cursor.execute("SELECT value FROM settings WHERE key = 'interval_hours'").fetchone()
+    interval_seconds = max(1, int(row[0] or 8) if row else 8) * 3600
+
+    # Nobody is due sooner than one interval after their last message; users messaged together
+    # by the batch mode still get spread over the interval after that
+    last_sent_or_now = """COALESCE(
+        CAST(strftime('%s', last_message_sent) AS INTEGER) + :interval, CAST(strftime('%s', 'now') AS INTEGER)
+    )"""
+    cursor.execute(f"""
+        UPDATE users SET next_auto_message_at = {_spread_due_sql(last_sent_or_now)}
+        WHERE is_active = 1
+    """, {"interval": interval_seconds})
+
+
+def _migration_broadcast_shards(cursor: sqlite3.Cursor):
+    """broadcast_job_shards table for multi-process sending"""
+    # Number of user_id ranges the job was split into; 0 means it is sent in-process
+    cursor.execute("ALTER TABLE broadcast_jobs ADD COLUMN shards INTEGER NOT NULL DEFAULT 0")
+    # One row per range, claimed by a sender worker process that renews its heartbeat while sending
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_job_shards (
+            job_id INTEGER NOT NULL,
+            shard INTEGER NOT NULL,
+            cursor INTEGER NOT NULL,
+            last_user_id INTEGER NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            success INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'running',
+            owner TEXT,
+            heartbeat INTEGER,
+            PRIMARY KEY (job_id, shard)
+        ) WITHOUT ROWID
+    """)
+
+
+def _migration_sender_bots(cursor: sqlite3.Cursor):
+    """users.bot_mask: which sender bots each user has started"""
+    # Bit i is set once the user has started sender bot i (bit 0 is the main bot)
+    cursor.execute("ALTER TABLE users ADD COLUMN bot_mask INTEGER NOT NULL DEFAULT 1")
+
+
+def _migration_files(cursor: sqlite3.Cursor):
+    """files table: the ordered bundle sent by the download button"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            position INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            file_name TEXT,
+            caption TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # The single file kept in settings so far becomes the first item of the bundle
+    cursor.execute("""
+        INSERT INTO files (file_id, file_type, file_name, caption)
+        SELECT f.value, COALESCE(t.value, 'document'), n.value, c.value
+        FROM settings f
+        LEFT JOIN settings t ON t.key = 'file_type'
+        LEFT JOIN settings n ON n.key = 'file_name'
+        LEFT JOIN settings c ON c.key = 'file_caption'
+        WHERE f.key = 'file_id' AND f.value IS NOT NULL
+    """)
+
+
+# Schema migrations in order; PRAGMA user_version holds how many have been applied.
+# Append new migrations to the end and never reorder or edit released ones.
+MIGRATIONS = [
+    _migration_initial_schema,
+    _migration_broadcast_jobs,
+    _migration_audience_indexes,
+    _migration_user_counters,
+    _migration_null_settings,
+    _migration_auto_message_schedule,
+    _migration_broadcast_shards,
+    _migration_sender_bots,
+    _migration_files,
+]
+
+
+@timed_methods(DB_QUERY_SECONDS)
 class Database:
+    # Page cache per connection in KiB (negative cache_size means KiB in SQLite)
+    CACHE_SIZE_KB = 16384
+    # Memory-map up to this many bytes of the database file for reads
+    MMAP_SIZE = 256 * 1024 * 1024
+    # Prepared statements kept per connection, keyed by SQL text
+    CACHED_STATEMENTS = 256
+
     def __init__(self, db_path: str = "bot_database.db"):
         self.db_path = db_path
+        # One shared connection; the lock serialises the event loop and worker threads
+        self._lock = threading.RLock()
+        self._conn = self._connect()
+        # Full copy of the settings table; every write goes through set_setting
+        self._settings: Dict[str, Optional[str]] = {}
         self._init_database()
+        self._load_settings()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the long-lived connection and apply performance pragmas"""
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=self.CACHED_STATEMENTS
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only syncs at checkpoints and stays safe against corruption
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{self.CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={self.MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def close(self):
+        """Close the shared connection"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
 
     def _init_database(self):
-        """Initialize database tables"""
+        """Bring the schema up to date by applying pending migrations"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            
-            # Users table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    is_active INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_message_sent TIMESTAMP
-                )
-            """)
-            
-            # Settings table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                )
-            """)
-            
-            # Initialize default settings
-            default_settings = {
-                "channel_link": "https://t.me/bigmumbaiofficial",
-                "button_text": "Join Big Mumbai Channel",
-                "file_button_text": "📥 Download Files",
-                "caption_text": "Welcome to Big Mumbai Official! Join our channel to stay updated.",
-                "image_file_id": None,
-                "file_id": None,
-                "file_type": None,
-                "file_name": None,
-                "file_caption": None,
-                "auto_message_text": "Don't forget to join our channel for latest updates!",
-                "interval_hours": "8",
-                "auto_messages_enabled": "1"
-            }
-            
-            for key, value in default_settings.items():
-                cursor.execute(
-                    "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
-                    (key, str(value))
-                )
-            
-            conn.commit()
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                # Each migration and its version bump commit together or not at all
+                cursor.execute("BEGIN")
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+                logger.info(f"Applied database migration {number}: {migration.__doc__}")
             logger.info("Database initialized successfully")
 
     @contextmanager
     def _get_connection(self):
-        """Context manager for database connections"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        try:
-            yield conn
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            logger.error(f"Database error: {e}")
-            raise
-        finally:
-            conn.close()
+        """Context manager giving exclusive use of the shared connection for one transaction"""
+        with self._lock:
+            conn = self._conn
+            try:
+                yield conn
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Database error: {e}")
+                raise
 
-    def add_user(self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None):
+    # Keeps created_at and last_message_sent of returning users, unlike INSERT OR REPLACE
+    _UPSERT_USER_SQL = """
+        INSERT INTO users (user_id, username, first_name, is_active, bot_mask)
+        VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username,
+            first_name = excluded.first_name,
+            is_active = 1,
+            bot_mask = bot_mask | excluded.bot_mask
+    """
+
+    def add_user(self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None,
+                 bot_mask: int = 1):
         """Add or update user in database"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO users (user_id, username, first_name, is_active)
-                VALUES (?, ?, ?, 1)
-            """, (user_id, username, first_name))
-            logger.info(f"User {user_id} added/updated in database")
+            cursor.execute(self._UPSERT_USER_SQL, (user_id, username, first_name, bot_mask))
+            logger.debug(f"User {user_id} added/updated in database")
 
-    def get_active_users(self) -> List[Dict]:
-        """Get all active users"""
+    def add_users_many(self, users: List[tuple]):
+        """Add or update many (user_id, username, first_name, bot_mask) rows in one transaction"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT user_id, username, first_name FROM users WHERE is_active = 1")
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.executemany(self._UPSERT_USER_SQL, users)
+            logger.debug(f"{len(users)} users added/updated in database")
+
+    def get_active_users_page(self, after_user_id: int = 0, limit: int = 1000) -> List[Tuple]:
+        """Get up to limit active users with user_id > after_user_id as (user_id, username, first_name)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            # Plain tuples are much smaller than sqlite3.Row / dict objects
+            cursor.row_factory = None
+            cursor.execute("""
+                SELECT user_id, username, first_name FROM users
+                WHERE is_active = 1 AND user_id > ?
+                ORDER BY user_id
+                LIMIT ?
+            """, (after_user_id, limit))
+            return cursor.fetchall()
 
     def mark_user_inactive(self, user_id: int):
         """Mark user as inactive"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_active = 0 WHERE user_id = ?", (user_id,))
-            logger.info(f"User {user_id} marked as inactive")
+            logger.debug(f"User {user_id} marked as inactive")
 
     def update_last_message_sent(self, user_id: int):
         """Update last message sent timestamp"""
@@ -109,33 +371,507 @@ class Database:
                 (user_id,)
             )
 
-    def get_setting(self, key: str) -> Optional[str]:
-        """Get setting value by key"""
+    def update_last_message_sent_many(self, user_ids: List[int], chunk_size: int = 500):
+        """Update last message sent timestamp for many users, one transaction per chunk"""
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany(
+                    "UPDATE users SET last_message_sent = CURRENT_TIMESTAMP WHERE user_id = ?",
+                    [(user_id,) for user_id in chunk]
+                )
+
+    def mark_users_inactive_many(self, user_ids: List[int], chunk_size: int = 500):
+        """Mark many users as inactive, one transaction per chunk"""
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany(
+                    "UPDATE users SET is_active = 0 WHERE user_id = ?",
+                    [(user_id,) for user_id in chunk]
+                )
+            logger.debug(f"{len(chunk)} users marked as inactive")
+
+    def _load_settings(self):
+        """Load the whole settings table into the in-memory cache"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-            row = cursor.fetchone()
-            return row["value"] if row else None
+            cursor.execute("SELECT key, value FROM settings")
+            self._settings = {row["key"]: row["value"] for row in cursor.fetchall()}
+
+    def get_setting(self, key: str) -> Optional[str]:
+        """Get setting value by key (served from the in-memory cache)"""
+        return self._settings.get(key)
+
+    def get_settings(self, *keys: str) -> Dict[str, Optional[str]]:
+        """Get several settings at once; missing keys map to None"""
+        settings = self._settings
+        return {key: settings.get(key) for key in keys}
 
     def set_setting(self, key: str, value: str):
-        """Set setting value"""
+        """Set setting value and update the cache"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
-            logger.info(f"Setting {key} updated to {value}")
+            # Update the cache only once the row is written, still under the connection lock
+            self._settings[key] = str(value)
+            # Values can be long (captions, auto message text), so only the key is logged
+            logger.info(f"Setting {key} updated")
+
+    def get_files(self) -> List[Dict]:
+        """Get the download bundle in upload order"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT file_id, file_type, file_name, caption FROM files ORDER BY position")
+            return [dict(row) for row in cursor.fetchall()]
+
+    def add_file(self, file_id: str, file_type: str, file_name: Optional[str] = None,
+                 caption: Optional[str] = None) -> int:
+        """Append a file to the download bundle; returns the bundle size"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO files (file_id, file_type, file_name, caption) VALUES (?, ?, ?, ?)",
+                (file_id, file_type, file_name, caption)
+            )
+            return cursor.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def clear_files(self):
+        """Remove every file from the download bundle"""
+        with self._get_connection() as conn:
+            conn.execute("DELETE FROM files")
 
     def get_stats(self) -> Dict:
-        """Get bot statistics"""
+        """Get bot statistics from the trigger-maintained counters"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) as total FROM users")
-            total_users = cursor.fetchone()["total"]
-            
-            cursor.execute("SELECT COUNT(*) as active FROM users WHERE is_active = 1")
-            active_users = cursor.fetchone()["active"]
+            cursor.execute("SELECT name, value FROM user_counters")
+            counters = {row["name"]: row["value"] for row in cursor.fetchall()}
             
             return {
-                "total_users": total_users,
-                "active_users": active_users
+                "total_users": counters.get("total", 0),
+                "active_users": counters.get("active", 0)
             }
 
+
+    @staticmethod
+    def _create_shards(cursor: sqlite3.Cursor, job_id: int, total: int, shards: int):
+        """Split a job's targets into up to `shards` user_id ranges of equal size"""
+        shards = min(shards, total)
+        start = 0
+        for shard in range(shards):
+            count = (shard + 1) * total // shards - shard * total // shards
+            cursor.execute("""
+                SELECT user_id FROM broadcast_targets WHERE job_id = ? AND user_id > ?
+                ORDER BY user_id LIMIT 1 OFFSET ?
+            """, (job_id, start, count - 1))
+            end = cursor.fetchone()[0]
+            cursor.execute("""
+                INSERT INTO broadcast_job_shards (job_id, shard, cursor, last_user_id, total)
+                VALUES (?, ?, ?, ?, ?)
+            """, (job_id, shard, start, end, count))
+            start = end
+        cursor.execute("UPDATE broadcast_jobs SET shards = ? WHERE job_id = ?", (shards, job_id))
+
+    def create_broadcast_job(self, kind: str, payload: Dict, shards: int = 0, now: Optional[int] = None,
+                             interval_seconds: Optional[int] = None) -> int:
+        """Create a broadcast job targeting every currently active user
+
+        With shards > 0 the audience is split into that many user_id ranges for sender workers.
+        With now and interval_seconds (auto messages), every target's next auto message is moved
+        to their own slot at least one interval after now, so switching to spread mode afterwards
+        neither sends them the message again nor sends it to everyone at once.
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO broadcast_jobs (kind, payload) VALUES (?, ?)",
+                (kind, json.dumps(payload))
+            )
+            job_id = cursor.lastrowid
+            cursor.execute("""
+                INSERT INTO broadcast_targets (job_id, user_id)
+                SELECT ?, user_id FROM users WHERE is_active = 1
+            """, (job_id,))
+            total = cursor.rowcount
+            if interval_seconds:
+                cursor.execute(f"""
+                    UPDATE users SET next_auto_message_at = {_spread_due_sql(":now + :interval")}
+                    WHERE user_id IN (SELECT user_id FROM broadcast_targets WHERE job_id = :job_id)
+                """, {"now": now, "interval": interval_seconds, "job_id": job_id})
+            cursor.execute("UPDATE broadcast_jobs SET total = ? WHERE job_id = ?", (total, job_id))
+            if shards:
+                self._create_shards(cursor, job_id, total, shards)
+            logger.info(f"Broadcast job {job_id} ({kind}) created for {total} users")
+            return job_id
+
+    def create_due_broadcast_job(self, kind: str, payload: Dict, now: int, interval_seconds: int,
+                                 shards: int = 0) -> Optional[int]:
+        """Create a job for every active user due by now and schedule their next one
+
+        Users without a due time yet (new registrations) are first scheduled at their slot at
+        least one interval from now. Returns None if nobody is due.
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            schedule = {"now": now, "interval": interval_seconds}
+            cursor.execute(f"""
+                UPDATE users SET next_auto_message_at = {_spread_due_sql(":now + :interval")}
+                WHERE is_active = 1 AND next_auto_message_at IS NULL
+            """, schedule)
+            cursor.execute("""
+                SELECT 1 FROM users WHERE is_active = 1 AND next_auto_message_at <= ? LIMIT 1
+            """, (now,))
+            if cursor.fetchone() is None:
+                return None
+
+            cursor.execute(
+                "INSERT INTO broadcast_jobs (kind, payload) VALUES (?, ?)",
+                (kind, json.dumps(payload))
+            )
+            job_id = cursor.lastrowid
+            cursor.execute("""
+                INSERT INTO broadcast_targets (job_id, user_id)
+                SELECT ?, user_id FROM users WHERE is_active = 1 AND next_auto_message_at <= ?
+            """, (job_id, now))
+            total = cursor.rowcount
+            # Claimed together with the snapshot: the job is resumable, so a restart cannot skip
+            # these users. They are due again one interval after their slot; users overdue after
+            # downtime get at least half an interval before the next one
+            cursor.execute(f"""
+                UPDATE users SET next_auto_message_at = {_spread_due_sql(
+                    "max(next_auto_message_at + :interval, :now + :interval / 2)"
+                )}
+                WHERE user_id IN (SELECT user_id FROM broadcast_targets WHERE job_id = :job_id)
+            """, {**schedule, "job_id": job_id})
+            cursor.execute("UPDATE broadcast_jobs SET total = ? WHERE job_id = ?", (total, job_id))
+            if shards:
+                self._create_shards(cursor, job_id, total, shards)
+            logger.info(f"Broadcast job {job_id} ({kind}) created for {total} due users")
+            return job_id
+
+    def get_broadcast_job(self, job_id: int) -> Optional[Dict]:
+        """Get broadcast job by id"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM broadcast_jobs WHERE job_id = ?", (job_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            job = dict(row)
+            job["payload"] = json.loads(job["payload"])
+            return job
+
+    def get_unfinished_broadcast_jobs(self, kind: Optional[str] = None) -> List[Dict]:
+        """Get jobs that were interrupted before completion, oldest first"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            if kind:
+                cursor.execute(
+                    "SELECT job_id FROM broadcast_jobs WHERE status = 'running' AND kind = ? ORDER BY job_id",
+                    (kind,)
+                )
+            else:
+                cursor.execute("SELECT job_id FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id")
+            job_ids = [row["job_id"] for row in cursor.fetchall()]
+        return [self.get_broadcast_job(job_id) for job_id in job_ids]
+
+    # Upper bound used when a target range has no last user
+    MAX_USER_ID = 2 ** 63 - 1
+
+    def get_broadcast_targets(self, job_id: int, after_user_id: int, limit: int,
+                              last_user_id: Optional[int] = None) -> List[int]:
+        """Get the next page of target user ids after the job cursor, up to last_user_id"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute("""
+                SELECT user_id FROM broadcast_targets
+                WHERE job_id = ? AND user_id > ? AND user_id <= ?
+                ORDER BY user_id
+                LIMIT ?
+            """, (job_id, after_user_id, self.MAX_USER_ID if last_user_id is None else last_user_id, limit))
+            return [row[0] for row in cursor.fetchall()]
+
+    def iter_broadcast_targets(self, job_id: int, after_user_id: int = 0, page_size: int = 1000,
+                               last_user_id: Optional[int] = None) -> Iterator[int]:
+        """Stream a job's target user ids in order, one keyset page at a time"""
+        while True:
+            page = self.get_broadcast_targets(job_id, after_user_id, page_size, last_user_id)
+            if not page:
+                return
+            yield from page
+            after_user_id = page[-1]
+
+    def get_broadcast_recipients(self, job_id: int, after_user_id: int, limit: int,
+                                 last_user_id: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Like get_broadcast_targets, but as (user_id, bot_mask) for choosing a sender bot"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute("""
+                SELECT t.user_id, u.bot_mask FROM broadcast_targets t
+                JOIN users u ON u.user_id = t.user_id
+                WHERE t.job_id = ? AND t.user_id > ? AND t.user_id <= ?
+                ORDER BY t.user_id
+                LIMIT ?
+            """, (job_id, after_user_id, self.MAX_USER_ID if last_user_id is None else last_user_id, limit))
+            return cursor.fetchall()
+
+    def checkpoint_broadcast_job(self, job_id: int, cursor_user_id: int, success: int, failed: int):
+        """Advance the job cursor past a delivered batch and add its counts"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE broadcast_jobs
+                SET cursor = ?, success = success + ?, failed = failed + ?, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = ?
+            """, (cursor_user_id, success, failed, job_id))
+
+    def finish_broadcast_job(self, job_id: int):
+        """Mark job as done and drop its audience snapshot"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE broadcast_jobs SET status = 'done', updated_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+                (job_id,)
+            )
+            cursor.execute("DELETE FROM broadcast_targets WHERE job_id = ?", (job_id,))
+
+    def get_broadcast_shard(self, job_id: int, shard: int) -> Optional[Dict]:
+        """Get one user_id range of a sharded job"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM broadcast_job_shards WHERE job_id = ? AND shard = ?", (job_id, shard))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def claim_broadcast_shard(self, owner: str, stale_after: int = 60) -> Optional[Dict]:
+        """Take the oldest unowned running shard, or one whose owner stopped sending heartbeats"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT job_id, shard, owner FROM broadcast_job_shards
+                WHERE status = 'running'
+                AND (owner IS NULL OR heartbeat < CAST(strftime('%s', 'now') AS INTEGER) - ?)
+                ORDER BY job_id, shard
+                LIMIT 1
+            """, (stale_after,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            # Another worker may have claimed it since the SELECT; only the owner we saw is replaced
+            cursor.execute("""
+                UPDATE broadcast_job_shards
+                SET owner = ?, heartbeat = CAST(strftime('%s', 'now') AS INTEGER)
+                WHERE job_id = ? AND shard = ? AND owner IS ?
+            """, (owner, row["job_id"], row["shard"], row["owner"]))
+            if cursor.rowcount != 1:
+                return None
+            cursor.execute(
+                "SELECT * FROM broadcast_job_shards WHERE job_id = ? AND shard = ?", (row["job_id"], row["shard"])
+            )
+            return dict(cursor.fetchone())
+
+    def heartbeat_broadcast_shard(self, job_id: int, shard: int, owner: str):
+        """Record that owner is still sending the shard"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE broadcast_job_shards SET heartbeat = CAST(strftime('%s', 'now') AS INTEGER)
+                WHERE job_id = ? AND shard = ? AND owner = ?
+            """, (job_id, shard, owner))
+
+    def release_broadcast_shards(self):
+        """Drop every shard claim, e.g. when the bot starts a fresh set of workers"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE broadcast_job_shards SET owner = NULL WHERE status = 'running'")
+
+    def checkpoint_broadcast_shard(self, job_id: int, shard: int, cursor_user_id: int, success: int, failed: int,
+                                   owner: Optional[str] = None) -> bool:
+        """Advance a shard cursor and add its counts to both the shard and the whole job
+
+        Only the shard's current owner (None for an unclaimed shard sent by the bot process)
+        may do so; returns False if the claim was taken over by another worker.
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE broadcast_job_shards
+                SET cursor = ?, success = success + ?, failed = failed + ?,
+                    heartbeat = CAST(strftime('%s', 'now') AS INTEGER)
+                WHERE job_id = ? AND shard = ? AND owner IS ?
+            """, (cursor_user_id, success, failed, job_id, shard, owner))
+            if cursor.rowcount == 0:
+                return False
+            cursor.execute("""
+                UPDATE broadcast_jobs
+                SET success = success + ?, failed = failed + ?, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = ?
+            """, (success, failed, job_id))
+            return True
+
+    def finish_broadcast_shard(self, job_id: int, shard: int, owner: Optional[str] = None) -> bool:
+        """Mark owner's shard as done; returns True if it was the last one and the job is now done"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE broadcast_job_shards SET status = 'done' WHERE job_id = ? AND shard = ? AND owner IS ?",
+                (job_id, shard, owner)
+            )
+            if cursor.rowcount == 0:
+                return False
+            cursor.execute(
+                "SELECT 1 FROM broadcast_job_shards WHERE job_id = ? AND status = 'running' LIMIT 1", (job_id,)
+            )
+            if cursor.fetchone() is not None:
+                return False
+            cursor.execute(
+                "UPDATE broadcast_jobs SET status = 'done', updated_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+                (job_id,)
+            )
+            cursor.execute("DELETE FROM broadcast_targets WHERE job_id = ?", (job_id,))
+            cursor.execute("DELETE FROM broadcast_job_shards WHERE job_id = ?", (job_id,))
+            return True
+
+
+class AsyncDatabase:
+    """Awaitable facade over Database that runs every query on one dedicated thread
+
+    Method calls are forwarded to the wrapped Database and return coroutines, e.g.
+    ``await adb.add_user(...)``. Settings reads are served from memory and stay synchronous.
+    """
+
+    # Served from the settings cache, so calling them directly never blocks the event loop
+    INLINE_METHODS = {"get_setting", "get_settings"}
+
+    def __init__(self, db: Database):
+        self.db = db
+        # A single worker keeps operations in submission order, like a queue in front of SQLite
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Run func(*args, **kwargs) on the database thread and await its result"""
+        loop = asyncio.get_running_loop()
+        if not PROFILER.enabled:
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        # Includes the wait behind earlier queries, which is part of what the caller sees
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        finally:
+            PROFILER.record_db(func.__name__, time.perf_counter() - start)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.db, name)
+        if name in self.INLINE_METHODS or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return call
+
+    async def iter_broadcast_targets(self, job_id: int, after_user_id: int = 0, page_size: int = 1000,
+                                     last_user_id: Optional[int] = None) -> AsyncIterator[int]:
+        """Async version of Database.iter_broadcast_targets"""
+        while True:
+            page = await self.run(self.db.get_broadcast_targets, job_id, after_user_id, page_size, last_user_id)
+            if not page:
+                return
+            for user_id in page:
+                yield user_id
+            after_user_id = page[-1]
+
+    async def iter_broadcast_recipients(self, job_id: int, after_user_id: int = 0, page_size: int = 1000,
+                                        last_user_id: Optional[int] = None) -> AsyncIterator[Tuple[int, int]]:
+        """Stream a job's (user_id, bot_mask) pairs in user_id order, fetching pages on the database thread"""
+        while True:
+            page = await self.run(self.db.get_broadcast_recipients, job_id, after_user_id, page_size, last_user_id)
+            if not page:
+                return
+            for recipient in page:
+                yield recipient
+            after_user_id = page[-1][0]
+
+    def close(self):
+        """Finish queued operations, then close the database"""
+        self._executor.shutdown(wait=True)
+        self.db.close()
+
+
+class UserRegistrationBuffer:
+    """Write-behind buffer for /start registrations
+
+    Repeated registrations of the same user are coalesced in memory and all pending
+    rows are upserted in one transaction every flush_interval seconds, or sooner once
+    max_rows users are waiting.
+    """
+
+    def __init__(self, adb: AsyncDatabase, flush_interval: float = 0.5, max_rows: int = 500):
+        self.adb = adb
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, tuple] = {}
+        self._wakeup = asyncio.Event()
+
+    def add(self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None,
+            sender_index: int = 0):
+        """Queue a user registration; the latest profile data wins"""
+        bot_mask = 1 << sender_index
+        previous = self._pending.get(user_id)
+        if previous:
+            # Remember every sender bot started since the last flush
+            bot_mask |= previous[3]
+        self._pending[user_id] = (user_id, username, first_name, bot_mask)
+        if len(self._pending) >= self.max_rows:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Write every pending registration now"""
+        if not self._pending:
+            return
+        rows = list(self._pending.values())
+        self._pending = {}
+        try:
+            await self.adb.add_users_many(rows)
+        except Exception:
+            # Keep the rows for the next flush, without overwriting newer registrations
+            for row in rows:
+                newer = self._pending.get(row[0])
+                self._pending[row[0]] = row if newer is None else newer[:3] + (newer[3] | row[3],)
+            raise
+
+    async def run(self):
+        """Flush on a timer or when the buffer fills up"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush user registrations: {e}", exc_info=True)
+
+    def start(self) -> asyncio.Task:
+        """Start the background flush loop"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        """Stop the flush loop and write whatever is still pending"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
@@ -0,0 +1,401 @@
+import asyncio
+import functools
+import inspect
+import logging
+import random
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Coroutine, Dict, Iterable, List, Optional, Union
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+from metrics import DELIVERY_MESSAGES, DELIVERY_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+async def _notify(callback: Optional[Callable], *args):
+    """Run a sync or async result callback without letting it kill the worker"""
+    if callback is None:
+        return
+    try:
+        result = callback(*args)
+        if inspect.isawaitable(result):
+            await result
+    except Exception as e:
+        logger.error(f"Delivery callback failed for {args[0]}: {e}", exc_info=True)
+
+
+def is_blocked_error(error: Exception) -> bool:
+    """True if the recipient can never be reached (blocked the bot, deleted account, unknown chat)"""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and "chat not found" in error.message.lower()
+
+
+def is_transient_error(error: Exception) -> bool:
+    """True if the same send may succeed when retried later"""
+    if isinstance(error, RetryAfter):
+        return True
+    # TimedOut subclasses NetworkError, but so does BadRequest, which will fail again
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+class RetryPolicy:
+    """Bounded exponential backoff for transient send failures"""
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        """Delay before the attempt after `attempt`, with jitter so retries do not arrive in lockstep"""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+
+class TokenBucket:
+    """Async token bucket refilled at `rate` tokens per second"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        # The lock keeps waiters in FIFO order while one of them sleeps for a refill
+        async with self._lock:
+            while True:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def delay(self) -> float:
+        """Seconds until the next token, ignoring callers already waiting for one"""
+        now = time.monotonic()
+        start = max(now, self._updated)
+        tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+        return (start - now) + max(0.0, (1 - tokens) / self.rate)
+
+    def take(self):
+        """Take a token without waiting, borrowing from future refills if the bucket is empty"""
+        self._refill(max(time.monotonic(), self._updated))
+        self._tokens -= 1
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for `seconds`, then resume from an empty bucket"""
+        until = time.monotonic() + seconds
+        if until > self._updated:
+            # Refill is computed from _updated, so moving it forward yields nothing before `until`
+            self._tokens = min(self._tokens, 0.0)
+            self._updated = until
+
+
+class RateLimiter:
+    """Global msgs/sec budget plus a minimum spacing between sends to the same chat"""
+
+    # Forget per-chat timestamps once this many chats are tracked
+    _CHAT_PRUNE_THRESHOLD = 10000
+
+    def __init__(self, global_rate: float, per_chat_rate: float):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_interval = 1.0 / per_chat_rate if per_chat_rate > 0 else 0.0
+        self._chat_next_send: Dict[int, float] = {}
+
+    def _prune_chats(self, now: float):
+        self._chat_next_send = {
+            chat_id: next_send for chat_id, next_send in self._chat_next_send.items() if next_send > now
+        }
+
+    async def acquire(self, chat_id: int):
+        """Wait until a message to chat_id may be sent"""
+        if self.per_chat_interval:
+            now = time.monotonic()
+            if len(self._chat_next_send) > self._CHAT_PRUNE_THRESHOLD:
+                self._prune_chats(now)
+
+            # Reserve the chat's next slot before sleeping so concurrent sends queue up behind it
+            send_at = max(now, self._chat_next_send.get(chat_id, 0.0))
+            self._chat_next_send[chat_id] = send_at + self.per_chat_interval
+            if send_at > now:
+                await asyncio.sleep(send_at - now)
+
+        await self.global_bucket.acquire()
+
+    def delay(self) -> float:
+        """Seconds until the global budget allows another message, e.g. while paused by a flood wait"""
+        return self.global_bucket.delay()
+
+    def charge(self):
+        """Count a message sent outside the limiter against the global budget, without waiting"""
+        self.global_bucket.take()
+
+    def pause(self, seconds: float):
+        """Stop all sends for `seconds`, e.g. after Telegram answered with a flood wait"""
+        logger.warning(f"Flood wait: pausing outbound messages for {seconds:.0f}s")
+        self.global_bucket.pause(seconds)
+
+
+class InteractiveRateLimiter(BaseRateLimiter):
+    """Gives the bot's replies to users priority over bulk delivery in the shared budget
+
+    Replies are sent at once and charged to the RateLimiter that paces broadcasts, so the
+    broadcast workers wait for the borrowed tokens instead of the user. A flood wait
+    returned for a reply pauses bulk delivery as well.
+    """
+
+    # Bot API methods that count towards Telegram's per-bot message limit
+    COUNTED_METHODS = ("send", "copyMessage", "forwardMessage")
+
+    def __init__(self, rate_limiter: RateLimiter):
+        self.rate_limiter = rate_limiter
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict, List[Dict]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Any],
+    ) -> Union[bool, Dict, List[Dict]]:
+        if endpoint.startswith(self.COUNTED_METHODS) and endpoint != "sendChatAction":
+            self.rate_limiter.charge()
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            self.rate_limiter.pause(float(e.retry_after))
+            raise
+
+
+class DeliveryEngine:
+    """Sends one message per recipient with many requests in flight, paced by a RateLimiter"""
+
+    def __init__(self, rate_limiter: RateLimiter, concurrency: int = 20,
+                 retry_policy: Optional[RetryPolicy] = None):
+        self.rate_limiter = rate_limiter
+        self.concurrency = max(1, concurrency)
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying, or None if the failure is final"""
+        if attempt >= self.retry_policy.max_attempts or not is_transient_error(error):
+            return None
+        if isinstance(error, RetryAfter):
+            # The limiter holds every worker back; the retry just queues behind the pause
+            self.rate_limiter.pause(float(error.retry_after))
+            return 0.0
+        return self.retry_policy.backoff(attempt)
+
+    async def broadcast(
+        self,
+        chat_ids: Union[Iterable[int], AsyncIterable[int]],
+        send: Callable[[int], Awaitable],
+        on_sent: Optional[Callable[[int], Any]] = None,
+        on_failed: Optional[Callable[[int, Exception], Any]] = None,
+    ) -> Dict:
+        """Deliver to every chat_id using send(chat_id) and return success/failure counts
+
+        chat_ids may be a sync or async iterable; it is consumed lazily, a few recipients
+        ahead of the workers. Transient failures are rescheduled instead of occupying a worker while they back off;
+        on_failed only sees errors that survived every retry.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        # Caps recipients taken from chat_ids but not yet finished, including ones waiting to retry
+        window = asyncio.Semaphore(self.concurrency * 2)
+        all_done = asyncio.Event()
+        state = {"outstanding": 0, "producer_done": False}
+        stats = {"success": 0, "failed": 0, "retried": 0}
+
+        def finish():
+            state["outstanding"] -= 1
+            DELIVERY_QUEUE_DEPTH.dec()
+            window.release()
+            if state["producer_done"] and state["outstanding"] == 0:
+                all_done.set()
+
+        async def submit(chat_id: int):
+            await window.acquire()
+            state["outstanding"] += 1
+            DELIVERY_QUEUE_DEPTH.inc()
+            queue.put_nowait((chat_id, 1))
+
+        async def producer():
+            if hasattr(chat_ids, "__aiter__"):
+                async for chat_id in chat_ids:
+                    await submit(chat_id)
+            else:
+                for chat_id in chat_ids:
+                    await submit(chat_id)
+            state["producer_done"] = True
+            if state["outstanding"] == 0:
+                all_done.set()
+
+        async def worker():
+            while True:
+                chat_id, attempt = await queue.get()
+
+                await self.rate_limiter.acquire(chat_id)
+                try:
+                    await send(chat_id)
+                except TelegramError as e:
+                    delay = self._retry_delay(e, attempt)
+                    if delay is not None:
+                        stats["retried"] += 1
+                        DELIVERY_MESSAGES.inc("retried")
+                        loop.call_later(delay, queue.put_nowait, (chat_id, attempt + 1))
+                        continue
+                    stats["failed"] += 1
+                    DELIVERY_MESSAGES.inc("failed")
+                    await _notify(on_failed, chat_id, e)
+                except Exception as e:
+                    logger.error(f"Unexpected error delivering to {chat_id}: {e}", exc_info=True)
+                    stats["failed"] += 1
+                    DELIVERY_MESSAGES.inc("failed")
+                    await _notify(on_failed, chat_id, e)
+                else:
+                    stats["success"] += 1
+                    DELIVERY_MESSAGES.inc("sent")
+                    await _notify(on_sent, chat_id)
+                finish()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            await producer()
+            await all_done.wait()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return stats
+
+
+class Sender:
+    """One bot token used for bulk delivery, with its own rate limits"""
+
+    def __init__(self, index: int, bot: Any, rate_limiter: RateLimiter):
+        self.index = index
+        self.bot = bot
+        self.rate_limiter = rate_limiter
+
+
+class SenderPool:
+    """The bot tokens a broadcast can be delivered through
+
+    Each user has a bitmask of the sender bots they have started (a bot can only message
+    users who started it). A user is pinned to the highest-numbered of those bots, which
+    keeps bulk traffic off the main bot (index 0) where possible. If the pinned bot could
+    not send for more than failover_after seconds (a flood wait, or a long queue), the
+    user's bot with the shortest wait takes over.
+    """
+
+    def __init__(self, senders: List[Sender], failover_after: float = 2.0):
+        self.senders = senders
+        self.failover_after = failover_after
+
+    def __len__(self) -> int:
+        return len(self.senders)
+
+    def choose(self, bot_mask: int, wait: Optional[Callable[[Sender], float]] = None) -> Sender:
+        """Pick the sender for a user with the given bot_mask
+
+        wait(sender) estimates how long a new message would wait on that sender; by default
+        only its rate limiter is considered.
+        """
+        wait = wait or (lambda sender: sender.rate_limiter.delay())
+        candidates = [sender for sender in reversed(self.senders) if bot_mask >> sender.index & 1]
+        if not candidates:
+            return self.senders[0]
+        pinned = candidates[0]
+        if len(candidates) == 1 or wait(pinned) < self.failover_after:
+            return pinned
+        return min(candidates, key=wait)
+
+
+class PooledDeliveryEngine:
+    """Delivers through every sender in a SenderPool at once
+
+    Each sender has its own DeliveryEngine, so a sender held back by a flood wait only
+    stalls its own recipients: the router keeps handing everyone else to the other senders,
+    and queues up to `backlog` recipients for the waiting one before it has to wait too.
+    """
+
+    def __init__(self, pool: SenderPool, concurrency: int = 20, retry_policy: Optional[RetryPolicy] = None,
+                 backlog_seconds: float = 60.0):
+        self.pool = pool
+        self.engines = [DeliveryEngine(sender.rate_limiter, concurrency, retry_policy) for sender in pool.senders]
+        # Enough recipients to keep a sender busy for backlog_seconds at its rate limit
+        self.backlogs = [
+            max(concurrency * 4, int(sender.rate_limiter.global_bucket.rate * backlog_seconds))
+            for sender in pool.senders
+        ]
+
+    async def broadcast(
+        self,
+        recipients: AsyncIterable,
+        send: Callable[[Sender, int], Awaitable],
+        on_sent: Optional[Callable[[int], Any]] = None,
+        on_failed: Optional[Callable[[int, Exception], Any]] = None,
+    ) -> Dict:
+        """Deliver to every (chat_id, bot_mask) in recipients using send(sender, chat_id)
+
+        Returns the summed success/failure/retry counts of all senders.
+        """
+        queues = [asyncio.Queue(backlog) for backlog in self.backlogs]
+
+        def wait(sender: Sender) -> float:
+            # Time until the sender's limiter frees up, plus the time to work through its queue
+            limiter = sender.rate_limiter
+            return limiter.delay() + queues[sender.index].qsize() / limiter.global_bucket.rate
+
+        async def route():
+            try:
+                async for chat_id, bot_mask in recipients:
+                    await queues[self.pool.choose(bot_mask, wait).index].put(chat_id)
+            finally:
+                for queue in queues:
+                    await queue.put(None)
+
+        async def drain(queue: asyncio.Queue) -> AsyncIterator[int]:
+            while True:
+                chat_id = await queue.get()
+                if chat_id is None:
+                    return
+                yield chat_id
+
+        tasks = [
+            asyncio.create_task(engine.broadcast(
+                drain(queue), functools.partial(send, sender), on_sent=on_sent, on_failed=on_failed
+            ))
+            for sender, engine, queue in zip(self.pool.senders, self.engines, queues)
+        ]
+        try:
+            await route()
+            results = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        stats = {"success": 0, "failed": 0, "retried": 0}
+        for result in results:
+            for key in stats:
+                stats[key] += result[key]
+        return stats
@@ -0,0 +1,116 @@
+"""Non-blocking logging: records are queued on the calling thread and written by a background thread
+
+setup_logging() replaces logging.basicConfig. Code keeps using logging.getLogger(__name__)
+as usual; the root logger only holds a QueueHandler, so a log call on the event loop costs a
+queue put instead of a synchronous write to stderr. A filter in front of the queue
+rate-limits each call site and can sample chatty loggers, so hot paths cannot flood the log.
+"""
+import atexit
+import logging
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Dict, Optional, Tuple
+
+# Libraries that log every HTTP request at INFO; at broadcast scale that is one line per message
+NOISY_LOGGERS = ("httpx", "httpcore")
+
+
+class SamplingFilter(logging.Filter):
+    """Rate limit per call site plus optional sampling per logger
+
+    Each call site (file and line) may emit `rate` records per second, with bursts of up to
+    `burst`. The next record let through from a call site that was held back says how many
+    were dropped. `sample_rates` maps logger names to the share of their records below
+    WARNING that is kept, e.g. {"bot": 0.1}; it applies to child loggers too.
+    """
+
+    def __init__(self, rate: float = 20.0, burst: float = 100.0, sample_rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.sample_rates = sample_rates or {}
+        # call site -> [tokens, last refill time, records dropped since the last one let through]
+        self._sites: Dict[Tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def _sample_rate(self, name: str) -> float:
+        while name:
+            if name in self.sample_rates:
+                return self.sample_rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and self.sample_rates:
+            if random.random() >= self._sample_rate(record.name):
+                return False
+        if not self.rate:
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = [self.burst, now, 0]
+            site[0] = min(self.burst, site[0] + (now - site[1]) * self.rate)
+            site[1] = now
+            if site[0] < 1:
+                site[2] += 1
+                return False
+            site[0] -= 1
+            dropped, site[2] = site[2], 0
+
+        if dropped:
+            record.msg = f"{record.getMessage()} [{dropped} similar messages suppressed]"
+            record.args = None
+        return True
+
+
+class _DeferredFormatQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the writer thread
+
+    The stock prepare() formats the record (including tracebacks) on the calling thread.
+    The listener lives in this process, so the record can be passed on as it is.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def parse_sample_rates(text: str) -> Dict[str, float]:
+    """Parse "logger=rate,logger=rate" as used by LOG_SAMPLE_RATES"""
+    rates = {}
+    for part in text.split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(fmt: str, level: int = logging.INFO, rate: float = 20.0,
+                  sample_rates: Optional[Dict[str, float]] = None) -> QueueListener:
+    """Route all logging through a queue to a stderr writer thread; returns the started listener"""
+    queue: SimpleQueue = SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(fmt))
+
+    queue_handler = _DeferredFormatQueueHandler(queue)
+    queue_handler.addFilter(SamplingFilter(rate, max(rate * 5, 1.0), sample_rates))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    listener = QueueListener(queue, stream, respect_handler_level=True)
+    listener.start()
+    # Write whatever is still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
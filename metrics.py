@@ -0,0 +1,371 @@
+"""In-process counters and histograms, served in the Prometheus text format
+
+Metrics are module-level objects that code records into directly, e.g.
+``DB_QUERY_SECONDS.observe(elapsed, "get_stats")``. MetricsServer exposes every
+registered metric at http://METRICS_LISTEN:METRICS_PORT/metrics and summary_lines()
+gives the short version shown in the admin Stats view.
+"""
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from telegram.request import HTTPXRequest
+
+from profiling import record_phase
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a fast SQLite lookup to a slow Telegram upload
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Tuple = ()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    """Base class: one named metric with a value per combination of label values
+
+    Metrics are updated from the event loop and from the database thread, so every
+    change happens under the metric's lock.
+    """
+
+    TYPE = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        """Lines of the Prometheus text format for this metric"""
+        with self._lock:
+            samples = self._samples()
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"] + samples
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        # Unlabelled metrics are exported as 0 before the first change
+        self._values: Dict[Tuple, float] = {} if self.labelnames else {(): 0}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        """Count for the given label values, or the sum over all of them if none are given"""
+        with self._lock:
+            if labels or not self.labelnames:
+                return self._values.get(labels, 0)
+            return sum(self._values.values())
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, e.g. a queue depth"""
+
+    TYPE = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. latencies, counted into fixed buckets"""
+
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: count per bucket (the last one is +Inf), then the sum of observations
+        self._values: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(labels) or self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observe the duration of the with-block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def _merged_counts(self, labels: Tuple) -> List[int]:
+        if labels or not self.labelnames:
+            entry = self._values.get(labels)
+            return list(entry[0]) if entry else [0] * (len(self.buckets) + 1)
+        merged = [0] * (len(self.buckets) + 1)
+        for counts, _ in self._values.values():
+            merged = [a + b for a, b in zip(merged, counts)]
+        return merged
+
+    def count(self, *labels: str) -> int:
+        """Number of observations for the given label values, or for all of them if none are given"""
+        with self._lock:
+            return sum(self._merged_counts(labels))
+
+    def quantile(self, q: float, *labels: str) -> Optional[float]:
+        """Estimate the q-quantile by interpolating within its bucket, like Prometheus' histogram_quantile"""
+        with self._lock:
+            counts = self._merged_counts(labels)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if index == len(self.buckets):
+                    # Beyond the largest bucket the best estimate is its bound
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total[0]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """The set of metrics rendered by the HTTP endpoint"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    "bot_handler_seconds", "Time spent in update handlers", ("handler",)
+))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "bot_handler_errors_total", "Update handlers that raised an exception", ("handler",)
+))
+DB_QUERY_SECONDS = REGISTRY.register(Histogram(
+    "bot_db_query_seconds", "Time spent in Database methods, including waiting for the connection", ("method",)
+))
+API_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "bot_telegram_request_seconds", "Duration of Telegram Bot API requests", ("method",)
+))
+API_RESPONSES = REGISTRY.register(Counter(
+    "bot_telegram_responses_total", "Telegram Bot API responses by HTTP status code", ("method", "code")
+))
+API_FLOOD_WAITS = REGISTRY.register(Counter(
+    "bot_telegram_flood_waits_total", "Telegram Bot API requests answered with 429 Too Many Requests", ("method",)
+))
+REQUESTS_SUPPRESSED = REGISTRY.register(Counter(
+    "bot_requests_suppressed_total", "User requests dropped as repeats or floods instead of answered",
+    ("action", "reason")
+))
+DELIVERY_MESSAGES = REGISTRY.register(Counter(
+    "bot_delivery_messages_total", "Broadcast and auto message sends by outcome (sent, failed, retried)",
+    ("outcome",)
+))
+DELIVERY_DEGRADED = REGISTRY.register(Counter(
+    "bot_delivery_degraded_total", "Broadcast copies that sender bots could only send as their text or photo"
+))
+DELIVERY_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "bot_delivery_queue_depth", "Broadcast recipients taken from the job but not yet delivered or failed"
+))
+
+
+def timed_handler(name: str) -> Callable:
+    """Decorator recording the duration and exceptions of an async update handler"""
+    def decorator(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorator
+
+
+def timed_methods(histogram: Histogram) -> Callable:
+    """Class decorator recording the duration of every public method, labelled by method name
+
+    Generator methods are left alone: they return before doing any work, and the page
+    queries they are built on are timed instead.
+    """
+    def wrap(name: str, method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, name)
+        return wrapper
+
+    def decorator(cls):
+        for name, attr in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.isfunction(attr) or inspect.isgeneratorfunction(attr):
+                continue
+            setattr(cls, name, wrap(name, attr))
+        return cls
+    return decorator
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records the duration and status code of every Bot API call"""
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        code = "error"
+        try:
+            result = await super().do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+            code = str(result[0])
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            API_REQUEST_SECONDS.observe(elapsed, api_method)
+            record_phase("api", elapsed)
+            API_RESPONSES.inc(api_method, code)
+            if code == "429":
+                API_FLOOD_WAITS.inc(api_method)
+
+
+def _ms(seconds: Optional[float]) -> str:
+    return "n/a" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+
+def summary_lines() -> List[str]:
+    """A few headline numbers since startup for the admin Stats view"""
+    lines = []
+    for handler, title in (("start", "/start"), ("download", "Downloads")):
+        count = HANDLER_SECONDS.count(handler)
+        lines.append(
+            f"{title}: {count} handled, p50 {_ms(HANDLER_SECONDS.quantile(0.5, handler))}, "
+            f"p99 {_ms(HANDLER_SECONDS.quantile(0.99, handler))}, {HANDLER_ERRORS.value(handler):.0f} errors"
+        )
+    lines.append(
+        f"Suppressed repeats: {REQUESTS_SUPPRESSED.value('start', 'duplicate') + REQUESTS_SUPPRESSED.value('start', 'flood'):.0f} /start, "
+        f"{REQUESTS_SUPPRESSED.value('download', 'duplicate') + REQUESTS_SUPPRESSED.value('download', 'flood'):.0f} downloads"
+    )
+    lines.append(
+        f"DB queries: {DB_QUERY_SECONDS.count()}, p99 {_ms(DB_QUERY_SECONDS.quantile(0.99))}"
+    )
+    lines.append(
+        f"API calls: {API_REQUEST_SECONDS.count()}, p99 {_ms(API_REQUEST_SECONDS.quantile(0.99))}, "
+        f"{API_FLOOD_WAITS.value():.0f} flood waits (429)"
+    )
+    lines.append(
+        f"Delivery: {DELIVERY_MESSAGES.value('sent'):.0f} sent, {DELIVERY_MESSAGES.value('failed'):.0f} failed, "
+        f"{DELIVERY_MESSAGES.value('retried'):.0f} retried, {DELIVERY_QUEUE_DEPTH.value():.0f} queued"
+    )
+    return lines
+
+
+class MetricsServer:
+    """Minimal HTTP server answering GET /metrics with REGISTRY in the Prometheus text format"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9464, registry: MetricsRegistry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Skip the headers; nothing in them matters here
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {self.CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        """Start listening; a port already in use is logged instead of stopping the bot"""
+        try:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info(f"Metrics available at http://{self.host}:{self.port}/metrics")
+        except OSError as e:
+            logger.error(f"Could not start metrics server on {self.host}:{self.port}: {e}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopLagMonitor:
+    """Measures how late the event loop wakes up a sleeping task
+
+    Anything that blocks the loop (synchronous I/O, CPU work) delays every other
+    coroutine by the same amount, so the lag is a direct measure of stalls.
+    """
+
+    def __init__(self, interval: float = 0.5, report_every: float = 60.0):
+        self.interval = interval
+        self.report_every = report_every
+        self.task: Optional[asyncio.Task] = None
+        self.reset()
+
+    def reset(self):
+        """Clear the collected samples"""
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def snapshot(self) -> Dict:
+        """Lag statistics in seconds since the last reset"""
+        return {
+            "samples": self.samples,
+            "avg_lag": self.total_lag / self.samples if self.samples else 0.0,
+            "max_lag": self.max_lag,
+        }
+
+    async def run(self):
+        """Sample lag forever, logging a summary every report_every seconds"""
+        loop = asyncio.get_running_loop()
+        last_report = loop.time()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+
+            if self.report_every and loop.time() - last_report >= self.report_every:
+                stats = self.snapshot()
+                logger.info(
+                    f"Event loop lag: avg {stats['avg_lag'] * 1000:.1f}ms, "
+                    f"max {stats['max_lag'] * 1000:.1f}ms over {stats['samples']} samples"
+                )
+                self.reset()
+                last_report = loop.time()
+
+    def start(self) -> asyncio.Task:
+        """Start sampling in the background"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def stop(self):
+        """Stop sampling"""
+        if self.task:
+            self.task.cancel()
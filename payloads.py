@@ -0,0 +1,253 @@
+import asyncio
+import itertools
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from telegram import (
+    Bot, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, InputMediaAudio, InputMediaDocument,
+    InputMediaPhoto, InputMediaVideo, Message
+)
+from telegram.error import BadRequest, TelegramError
+from db import Database
+
+logger = logging.getLogger(__name__)
+
+# Telegram accepts at most this many files in one media group
+MEDIA_GROUP_LIMIT = 10
+
+
+class MediaMirror:
+    """Makes the main bot's media usable from the other sender bots
+
+    A file_id only works for the bot that received the file, so the first time another
+    sender needs it the file is downloaded through the main bot and uploaded again. The
+    file_id Telegram assigns to that upload is remembered for later sends. Only one send per
+    sender and file uploads it; sends of the same file meanwhile wait for its file_id. The
+    downloaded bytes are kept until each of the `senders` extra bots has its own file_id.
+    """
+
+    def __init__(self, source_bot: Optional[Bot] = None, senders: int = 0):
+        self.source_bot = source_bot
+        self.senders = senders
+        self._file_ids: Dict[Tuple[int, str], str] = {}
+        # (sender_index, file_id) -> future of the file_id its upload produced (None if it failed)
+        self._uploads: Dict[Tuple[int, str], asyncio.Future] = {}
+        # file_id -> task downloading its bytes through the main bot
+        self._downloads: Dict[str, asyncio.Task] = {}
+
+    async def send(self, sender_index: int, files: Sequence[Tuple[str, Optional[str]]],
+                   send: Callable[[List[Union[str, InputFile]]], Awaitable[Any]]) -> Any:
+        """Call send with the media argument for each of the main bot's files (file_id, filename)
+
+        send gets a file_id usable by sender_index, or the file to upload, for each file and
+        returns the sent Message (or the tuple of them, for a media group).
+        """
+        if sender_index == 0:
+            return await send([file_id for file_id, _ in files])
+        uploading: List[str] = []
+        sent = None
+        try:
+            media = []
+            for file_id, filename in files:
+                key = (sender_index, file_id)
+                # Wait for another send's upload, unless this one holds uploads of its own: two
+                # sends of the same files in different orders would wait for each other
+                while key not in self._file_ids and key in self._uploads and not uploading:
+                    await asyncio.wait([self._uploads[key]])
+                if key in self._file_ids:
+                    media.append(self._file_ids[key])
+                    continue
+                if key not in self._uploads:
+                    self._uploads[key] = asyncio.get_running_loop().create_future()
+                    uploading.append(file_id)
+                media.append(InputFile(await self._download(file_id), filename=filename))
+            sent = await send(media)
+            return sent
+        finally:
+            if sent is not None:
+                for (file_id, _), message in zip(files, sent if isinstance(sent, tuple) else (sent,)):
+                    self._remember(sender_index, file_id, message)
+            for file_id in uploading:
+                self._uploads.pop((sender_index, file_id)).set_result(self._file_ids.get((sender_index, file_id)))
+
+    async def _download(self, file_id: str) -> bytes:
+        download = self._downloads.get(file_id)
+        if download is None or (download.done() and download.exception() is not None):
+            download = self._downloads[file_id] = asyncio.ensure_future(self._fetch(file_id))
+        # Shielded: a cancelled send must not cancel the download other senders are waiting for
+        return await asyncio.shield(download)
+
+    async def _fetch(self, file_id: str) -> bytes:
+        telegram_file = await self.source_bot.get_file(file_id)
+        return bytes(await telegram_file.download_as_bytearray())
+
+    def _remember(self, sender_index: int, file_id: str, message: Message):
+        """Store the file_id of media that sender_index just uploaded in message"""
+        if (sender_index, file_id) in self._file_ids:
+            return
+        attachment = message.effective_attachment
+        if isinstance(attachment, tuple):
+            # Photos come as a tuple of sizes; the last one is the original
+            attachment = attachment[-1] if attachment else None
+        if attachment is not None and hasattr(attachment, "file_id"):
+            self._file_ids[(sender_index, file_id)] = attachment.file_id
+            if all((index, file_id) in self._file_ids for index in range(1, self.senders + 1)):
+                self._downloads.pop(file_id, None)
+
+
+class WelcomePayload:
+    """The /start reply, built once from settings"""
+
+    KEYS = ("channel_link", "button_text", "file_button_text", "caption_text", "image_file_id")
+
+    def __init__(self, db: Database, mirror: Optional[MediaMirror] = None):
+        self.db = db
+        self.mirror = mirror or MediaMirror()
+        self.rebuild()
+
+    def rebuild(self):
+        """Rebuild caption, photo and keyboard from the current settings"""
+        settings = self.db.get_settings(*self.KEYS)
+        button_text = settings["button_text"] or "Join Big Mumbai Channel"
+        file_button_text = settings["file_button_text"] or "📥 Download Files"
+
+        self.caption = settings["caption_text"] or "Welcome to Big Mumbai Official!"
+        self.photo: Optional[str] = settings["image_file_id"]
+        self.reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton(button_text, url=settings["channel_link"])],
+            [InlineKeyboardButton(file_button_text, callback_data="download_file")]
+        ])
+
+    async def send(self, message: Message, sender_index: int = 0):
+        """Reply to message with the welcome photo, or text if there is none
+
+        sender_index is the sender bot the message came in through (0 for the main bot).
+        """
+        photo = self.photo
+        if photo:
+            try:
+                await self.mirror.send(sender_index, [(photo, None)], lambda media: message.reply_photo(
+                    photo=media[0],
+                    caption=self.caption,
+                    reply_markup=self.reply_markup
+                ))
+                return
+            except BadRequest as e:
+                if sender_index == 0:
+                    # Stop trying a broken file_id on every /start until an admin changes the image
+                    logger.warning(f"Failed to send photo, falling back to text until the image is updated: {e}")
+                    self.photo = None
+                else:
+                    logger.warning(f"Failed to send photo from sender bot {sender_index}, falling back to text: {e}")
+            except TelegramError as e:
+                logger.warning(f"Failed to send photo, falling back to text: {e}")
+
+        await message.reply_text(text=self.caption, reply_markup=self.reply_markup)
+
+
+class FilePayload:
+    """The download button reply: the whole file bundle in as few messages as possible
+
+    Telegram only groups photos with videos, documents with documents and audio with
+    audio, so the bundle is split into runs of compatible files in upload order. Each run
+    goes out as media groups of up to MEDIA_GROUP_LIMIT files; a lone file is sent with its
+    own method. The calls, including the InputMedia lists, are built once per bundle change.
+    """
+
+    # Settings this payload depends on; the bundle itself lives in the files table
+    KEYS = ()
+
+    # file_type -> (Message reply method, its media argument, InputMedia class); anything else is a document
+    SEND_METHODS = {
+        "photo": ("reply_photo", "photo", InputMediaPhoto),
+        "video": ("reply_video", "video", InputMediaVideo),
+        "audio": ("reply_audio", "audio", InputMediaAudio),
+        "document": ("reply_document", "document", InputMediaDocument),
+    }
+    # file_type -> which files it can share a media group with
+    GROUP_KINDS = {"photo": "visual", "video": "visual", "audio": "audio"}
+    DEFAULT_CAPTION = "📥 Here's your file!"
+
+    def __init__(self, db: Database, mirror: Optional[MediaMirror] = None):
+        self.db = db
+        self.mirror = mirror or MediaMirror()
+        self.rebuild()
+
+    def rebuild(self, files: Optional[List[Dict]] = None):
+        """Rebuild the reply calls from the bundle (rows of Database.get_files, read here if not given)"""
+        self.files: List[Dict] = files if files is not None else self.db.get_files()
+        # (files sent, Message method, its arguments for the main bot) per message of the reply
+        self._calls: List[Tuple[List[Dict], str, Dict]] = []
+        runs = itertools.groupby(self.files, key=lambda item: self.GROUP_KINDS.get(item["file_type"], "document"))
+        for _, run in runs:
+            run = list(run)
+            for start in range(0, len(run), MEDIA_GROUP_LIMIT):
+                items = run[start:start + MEDIA_GROUP_LIMIT]
+                self._calls.append((items, *self._call(items, [item["file_id"] for item in items])))
+
+    def _call(self, items: List[Dict], media: List[Union[str, InputFile]]) -> Tuple[str, Dict]:
+        """The Message method and arguments that send items, with media as their files"""
+        if len(items) == 1:
+            method_name, media_arg, _ = self.SEND_METHODS.get(items[0]["file_type"], self.SEND_METHODS["document"])
+            return method_name, {media_arg: media[0], "caption": items[0]["caption"] or self.DEFAULT_CAPTION}
+        group = [
+            self.SEND_METHODS.get(item["file_type"], self.SEND_METHODS["document"])[2](
+                media=file, caption=item["caption"]
+            )
+            for item, file in zip(items, media)
+        ]
+        return "reply_media_group", {"media": group}
+
+    async def send(self, message: Message, sender_index: int = 0):
+        """Reply to message with the file bundle, through the sender bot it came in on"""
+        if not self._calls:
+            await message.reply_text("❌ No file available at the moment. Please check back later.")
+            return
+        for items, method_name, kwargs in self._calls:
+            if sender_index == 0:
+                await getattr(message, method_name)(**kwargs)
+                continue
+
+            async def send(media: List[Union[str, InputFile]]):
+                method_name, kwargs = self._call(items, media)
+                return await getattr(message, method_name)(**kwargs)
+
+            await self.mirror.send(sender_index, [(item["file_id"], item["file_name"]) for item in items], send)
+
+
+async def send_media(bot: Bot, chat_id: int, items: List[Dict], mirror: MediaMirror, sender_index: int = 0,
+                     parse_mode: Optional[str] = None):
+    """Send the main bot's files in items (file_id, file_type, file_name, caption) through sender_index
+
+    One file goes out with its own method, several as one media group; items must fit in one.
+    """
+    methods = [FilePayload.SEND_METHODS.get(item["file_type"], FilePayload.SEND_METHODS["document"]) for item in items]
+
+    async def send(media: List[Union[str, InputFile]]):
+        if len(items) == 1:
+            _, media_arg, _ = methods[0]
+            return await getattr(bot, f"send_{media_arg}")(
+                chat_id=chat_id, caption=items[0]["caption"], parse_mode=parse_mode, **{media_arg: media[0]}
+            )
+        group = [
+            input_media(media=file, caption=item["caption"], parse_mode=parse_mode)
+            for (_, _, input_media), item, file in zip(methods, items, media)
+        ]
+        return await bot.send_media_group(chat_id=chat_id, media=group)
+
+    await mirror.send(sender_index, [(item["file_id"], item["file_name"]) for item in items], send)
+
+
+class ReplyPayloads:
+    """Prebuilt user-facing replies, rebuilt when an admin changes a setting they use"""
+
+    def __init__(self, db: Database, mirror: Optional[MediaMirror] = None):
+        # One mirror for both payloads, so each file is uploaded to each sender bot once
+        self.mirror = mirror or MediaMirror()
+        self.welcome = WelcomePayload(db, self.mirror)
+        self.file = FilePayload(db, self.mirror)
+
+    def refresh(self, key: str):
+        """Rebuild every payload that depends on the setting key"""
+        for payload in (self.welcome, self.file):
+            if key in payload.KEYS:
+                payload.rebuild()
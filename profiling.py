@@ -0,0 +1,220 @@
+"""Opt-in profiling: per-phase handler timers, a slow-operation log and on-demand captures
+
+With PROFILING_ENABLED, every registered handler runs inside a Trace that adds up how long
+it spent awaiting the database and the Bot API. A handler slower than SLOW_LOG_THRESHOLD_MS
+is written to the "slowlog" logger as one JSON line with that breakdown; whatever is left
+over ("other") went to the handler's own code or to waiting for the event loop. Database
+calls slower than the threshold are logged the same way, wherever they come from.
+
+Independently of that, PROFILER.capture() runs cProfile and a stack sampler on the
+event-loop thread for a while and saves both; admins start it from the admin panel.
+"""
+import asyncio
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+from telegram.ext import ConversationHandler
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("slowlog")
+
+
+class Trace:
+    """Time spent per phase ("db", "api") while handling one update"""
+
+    __slots__ = ("name", "start", "phases", "calls")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("profiling_trace", default=None)
+
+
+def record_phase(phase: str, seconds: float):
+    """Add time to the trace of the handler currently running, if it is being profiled"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(phase, seconds)
+
+
+def _fold_stack(frame) -> str:
+    """A stack as "outer;...;inner" function names, the folded format flame graph tools read"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    """Handler and database timers plus runtime profile captures; configured once by bot.py"""
+
+    def __init__(self):
+        self.enabled = False
+        self.threshold = 0.5
+        self.capture_seconds = 30.0
+        self.output_dir = "profiles"
+        self.sample_interval = 0.01
+        self._capturing = False
+
+    def configure(self, enabled: bool, threshold: float, capture_seconds: float = 30.0,
+                  output_dir: str = "profiles"):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.capture_seconds = capture_seconds
+        self.output_dir = output_dir
+
+    def log_slow(self, name: str, elapsed: float, trace: Optional[Trace] = None, **fields):
+        """Write one slow operation to the slow log as JSON"""
+        entry = {"event": "slow_operation", "name": name, "ms": round(elapsed * 1000, 1)}
+        if trace is not None:
+            accounted = sum(trace.phases.values())
+            entry["phases_ms"] = {phase: round(seconds * 1000, 1) for phase, seconds in trace.phases.items()}
+            entry["phases_ms"]["other"] = round(max(0.0, elapsed - accounted) * 1000, 1)
+            entry["calls"] = trace.calls
+        entry.update(fields)
+        slow_logger.warning(json.dumps(entry))
+
+    # -- handlers -----------------------------------------------------------------------
+
+    def wrap_callback(self, callback: Callable) -> Callable:
+        """Run an async handler callback inside a Trace and log it if it was slow"""
+        if getattr(callback, "_profiled", False):
+            return callback
+        name = f"{callback.__module__}.{callback.__qualname__}"
+
+        @functools.wraps(callback)
+        async def wrapper(update, context, *args, **kwargs):
+            trace = Trace(name)
+            token = _current_trace.set(trace)
+            try:
+                return await callback(update, context, *args, **kwargs)
+            finally:
+                _current_trace.reset(token)
+                elapsed = time.perf_counter() - trace.start
+                if elapsed >= self.threshold:
+                    user = getattr(update, "effective_user", None)
+                    self.log_slow(
+                        name, elapsed, trace,
+                        update_id=getattr(update, "update_id", None), user_id=user.id if user else None
+                    )
+
+        wrapper._profiled = True
+        return wrapper
+
+    def instrument_handler(self, handler):
+        """Wrap the callback of a handler, or of every handler inside a ConversationHandler"""
+        if isinstance(handler, ConversationHandler):
+            nested = list(handler.entry_points) + list(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                nested.extend(state_handlers)
+            for inner in nested:
+                self.instrument_handler(inner)
+        elif asyncio.iscoroutinefunction(getattr(handler, "callback", None)):
+            handler.callback = self.wrap_callback(handler.callback)
+
+    def instrument_application(self, application):
+        """Wrap every handler registered on the application"""
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                self.instrument_handler(handler)
+
+    # -- database -----------------------------------------------------------------------
+
+    def record_db(self, method: str, elapsed: float):
+        """Account a finished database call to the current trace and log it if it was slow"""
+        record_phase("db", elapsed)
+        if elapsed >= self.threshold:
+            self.log_slow(f"db.{method}", elapsed)
+
+    # -- captures -----------------------------------------------------------------------
+
+    @property
+    def capturing(self) -> bool:
+        return self._capturing
+
+    async def capture(self, seconds: Optional[float] = None) -> str:
+        """Profile the event-loop thread for `seconds` and return a short text summary
+
+        cProfile sees every function call (and slows the bot down while it runs); the
+        sampler thread records the loop thread's stack every sample_interval seconds, which
+        also catches time blocked in C code. Both are saved under output_dir.
+        """
+        if self._capturing:
+            raise RuntimeError("A profile capture is already running")
+        seconds = seconds or self.capture_seconds
+        self._capturing = True
+        loop_thread = threading.get_ident()
+        stacks: Counter = Counter()
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(self.sample_interval):
+                frame = sys._current_frames().get(loop_thread)
+                if frame is not None:
+                    stacks[_fold_stack(frame)] += 1
+
+        sampler = threading.Thread(target=sample, name="profile-sampler", daemon=True)
+        profile = cProfile.Profile()
+        try:
+            sampler.start()
+            profile.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            stop.set()
+            sampler.join()
+            self._capturing = False
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, time.strftime("profile-%Y%m%d-%H%M%S"))
+        profile.dump_stats(f"{base}.pstats")
+        with open(f"{base}.folded", "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Profile capture saved to {base}.pstats and {base}.folded")
+        return self._summary(profile, stacks, seconds, base)
+
+    @staticmethod
+    def _summary(profile: cProfile.Profile, stacks: Counter, seconds: float, base: str, top: int = 8) -> str:
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        lines: List[str] = [f"Profile of {seconds:.0f}s saved to {base}.pstats / .folded", "", "Top by own time:"]
+        for (filename, line, function), (_, calls, own, cumulative, _) in sorted(
+            stats.stats.items(), key=lambda item: item[1][2], reverse=True
+        )[:top]:
+            lines.append(f"{own * 1000:8.0f}ms {calls:>7} calls  {os.path.basename(filename)}:{line} {function}")
+
+        # Innermost frames of the samples: where the loop thread actually was
+        leaves: Counter = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values())
+        if total:
+            lines += ["", f"Loop thread samples ({total}):"]
+            for leaf, count in leaves.most_common(top):
+                lines.append(f"{count / total:6.1%}  {leaf}")
+        return "\n".join(lines)
+
+
+PROFILER = Profiler()
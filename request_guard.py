@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from metrics import REQUESTS_SUPPRESSED
+
+# Reasons a request is suppressed, as counted in REQUESTS_SUPPRESSED
+REASON_DUPLICATE = "duplicate"
+REASON_FLOOD = "flood"
+
+
+class RequestGuard:
+    """Per-user debounce and flood limit in front of expensive replies (/start, downloads)
+
+    A request repeating the same action from the same user through the same bot within
+    `debounce` seconds of the last one that was answered is a duplicate: the reply is
+    already on its way. Apart from that, each user gets a token bucket of `burst` answered
+    requests refilled at `per_minute` per minute across all actions. Both tables are kept
+    in last-use order, so entries older than their TTL are dropped from the front and at
+    most `max_users` entries are kept, evicting the least recently used.
+    """
+
+    def __init__(self, debounce: float = 3.0, per_minute: float = 20.0, burst: Optional[float] = None,
+                 max_users: int = 100000):
+        self.debounce = debounce
+        self.rate = per_minute / 60.0
+        self.burst = burst if burst is not None else max(1.0, per_minute / 4)
+        self.max_users = max(1, max_users)
+        # (user_id, bot_index, action) -> monotonic time it was last answered
+        self._recent: "OrderedDict[Tuple[int, int, str], float]" = OrderedDict()
+        # user_id -> [tokens, monotonic time of the last refill]
+        self._buckets: "OrderedDict[int, list]" = OrderedDict()
+
+    def _expire(self, now: float):
+        """Drop expired entries, and the oldest ones until there is room for one more"""
+        recent = self._recent
+        while recent and (len(recent) >= self.max_users or now - next(iter(recent.values())) >= self.debounce):
+            recent.popitem(last=False)
+        # A bucket untouched for this long has refilled completely, the same as no entry
+        full_after = self.burst / self.rate if self.rate else 0.0
+        buckets = self._buckets
+        while buckets and (len(buckets) >= self.max_users or now - next(iter(buckets.values()))[1] >= full_after):
+            buckets.popitem(last=False)
+
+    def suppressed(self, user_id: int, action: str, bot_index: int = 0) -> Optional[str]:
+        """The reason the request is suppressed (and counted), or None if it should be answered"""
+        now = time.monotonic()
+        self._expire(now)
+
+        key = (user_id, bot_index, action)
+        if self.debounce and key in self._recent:
+            REQUESTS_SUPPRESSED.inc(action, REASON_DUPLICATE)
+            return REASON_DUPLICATE
+
+        if self.rate:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets[user_id] = bucket
+            self._buckets.move_to_end(user_id)
+            if bucket[0] < 1:
+                REQUESTS_SUPPRESSED.inc(action, REASON_FLOOD)
+                return REASON_FLOOD
+            bucket[0] -= 1
+
+        if self.debounce:
+            self._recent[key] = now
+        return None
@@ -1,67 +1,106 @@
 import logging
 import asyncio
-from datetime import datetime, timedelta
+import time
+from typing import Optional
 from telegram import Bot
-from telegram.error import TelegramError
-from db import Database
+from db import AsyncDatabase
+from broadcast import BroadcastManager, JOB_AUTO
 
 logger = logging.getLogger(__name__)
 
 
+# Auto message delivery modes (auto_message_mode setting)
+AUTO_MODE_BATCH = "batch"    # everyone at once, once per interval
+AUTO_MODE_SPREAD = "spread"  # each user one interval after their previous message
+
+
 class MessageScheduler:
-    def __init__(self, db: Database, bot: Bot):
+    def __init__(self, db: AsyncDatabase, bot: Bot, broadcasts: BroadcastManager, tick_seconds: float = 60):
         self.db = db
         self.bot = bot
+        self.broadcasts = broadcasts
+        self.tick_seconds = tick_seconds
         self.is_running = False
         self.task = None
+        self._mode: Optional[str] = None
+
+    def _interval_seconds(self) -> int:
+        return max(1, int(self.db.get_setting("interval_hours") or "8")) * 3600
+
+    def _auto_message_text(self) -> Optional[str]:
+        """The auto message to send, or None if auto messages are off or empty"""
+        # Check if auto messages are enabled
+        if self.db.get_setting("auto_messages_enabled") != "1":
+            logger.debug("Auto messages are disabled")
+            return None
+
+        auto_message_text = self.db.get_setting("auto_message_text")
+        if not auto_message_text:
+            logger.warning("Auto message text is not set")
+            return None
+        return auto_message_text
+
+    async def _finish_previous_jobs(self) -> bool:
+        """Complete unfinished auto jobs first; True if there were any"""
+        jobs = await self.db.get_unfinished_broadcast_jobs(JOB_AUTO)
+        for job in jobs:
+            # Reuses the task if the job is still being sent; one whose task died (or that a
+            # restart interrupted) is started again from its checkpoint
+            await self.broadcasts.start_job(job["job_id"], self.bot)
+        return bool(jobs)
 
     async def send_auto_messages(self):
         """Send scheduled messages to all active users"""
         try:
-            # Check if auto messages are enabled
-            if self.db.get_setting("auto_messages_enabled") != "1":
-                logger.debug("Auto messages are disabled")
+            auto_message_text = self._auto_message_text()
+            if not auto_message_text:
                 return
 
-            auto_message_text = self.db.get_setting("auto_message_text")
-            if not auto_message_text:
-                logger.warning("Auto message text is not set")
+            if await self._finish_previous_jobs():
+                logger.info("Previous auto message batch was still running, skipping this one")
                 return
 
-            users = self.db.get_active_users()
-            logger.info(f"Sending auto messages to {len(users)} users")
-
-            success_count = 0
-            failed_count = 0
-
-            for user in users:
-                try:
-                    await self.bot.send_message(
-                        chat_id=user["user_id"],
-                        text=auto_message_text
-                    )
-                    self.db.update_last_message_sent(user["user_id"])
-                    success_count += 1
-                    logger.debug(f"Auto message sent to user {user['user_id']}")
-                    
-                    # Small delay to avoid rate limits
-                    await asyncio.sleep(0.05)
-                    
-                except TelegramError as e:
-                    logger.warning(f"Failed to send message to user {user['user_id']}: {e}")
-                    
-                    # Check if user blocked the bot
-                    if "blocked" in str(e).lower() or "chat not found" in str(e).lower():
-                        self.db.mark_user_inactive(user["user_id"])
-                        logger.info(f"User {user['user_id']} marked as inactive (blocked)")
-                    
-                    failed_count += 1
-
-            logger.info(f"Auto messages completed: {success_count} success, {failed_count} failed")
+            job_id = await self.broadcasts.create_auto_job(auto_message_text, self._interval_seconds())
+            await self.broadcasts.start_job(job_id, self.bot)
 
         except Exception as e:
             logger.error(f"Error in send_auto_messages: {e}", exc_info=True)
 
+    async def send_due_auto_messages(self):
+        """Send the auto message to every user whose next one is due"""
+        try:
+            auto_message_text = self._auto_message_text()
+            if not auto_message_text:
+                return
+
+            if await self._finish_previous_jobs():
+                logger.debug("Finished the previous auto message job first")
+                return
+
+            job_id = await self.broadcasts.create_due_auto_job(auto_message_text, self._interval_seconds())
+            if job_id:
+                await self.broadcasts.start_job(job_id, self.bot)
+
+        except Exception as e:
+            logger.error(f"Error in send_due_auto_messages: {e}", exc_info=True)
+
+    async def _schedule_next_batch(self):
+        interval_seconds = self._interval_seconds()
+        await self.db.set_setting("auto_message_next_run", str(int(time.time()) + interval_seconds))
+        logger.info(f"Waiting {interval_seconds // 3600} hours before next auto message batch...")
+
+    async def run_batch_if_due(self, mode_changed: bool):
+        """Send the batch if its persisted run time has passed"""
+        next_run = self.db.get_setting("auto_message_next_run")
+        # A saved time survives restarts; one left over from spread mode does not count
+        if next_run is None or mode_changed:
+            await self._schedule_next_batch()
+            return
+        if time.time() >= float(next_run):
+            # Move the run time first so a crash mid-batch cannot trigger the batch twice
+            await self._schedule_next_batch()
+            await self.send_auto_messages()
+
     async def scheduler_loop(self):
         """Main scheduler loop"""
         self.is_running = True
@@ -69,15 +108,16 @@ class MessageScheduler:
 
         while self.is_running:
             try:
-                # Get interval hours
-                interval_hours = int(self.db.get_setting("interval_hours") or "8")
-                
-                # Wait for the interval
-                logger.info(f"Waiting {interval_hours} hours before next auto message batch...")
-                await asyncio.sleep(interval_hours * 3600)  # Convert hours to seconds
-                
-                # Send messages
-                await self.send_auto_messages()
+                mode = self.db.get_setting("auto_message_mode") or AUTO_MODE_BATCH
+                mode_changed = self._mode is not None and mode != self._mode
+                self._mode = mode
+
+                if mode == AUTO_MODE_SPREAD:
+                    await self.send_due_auto_messages()
+                else:
+                    await self.run_batch_if_due(mode_changed)
+
+                await asyncio.sleep(self.tick_seconds)
 
             except asyncio.CancelledError:
                 logger.info("Scheduler cancelled")
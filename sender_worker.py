@@ -0,0 +1,214 @@
+"""Sender worker process for sharded broadcasts.
+
+bot.py starts SENDER_WORKERS of these when that setting is above 0. Each worker claims
+user_id ranges (shards) of broadcast jobs from the SQLite job tables and delivers them
+with its share of the global budget, BROADCAST_RATE_LIMIT * SENDER_WORKER_RATE_SHARE /
+SENDER_WORKERS. All workers together stay within the limit and leave the rest to the
+bot process's replies. A claim is kept alive by a heartbeat; if a
+worker dies, another one takes its shard over from the last checkpoint.
+
+    python sender_worker.py --workers 4
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import signal
+import socket
+import sys
+from typing import Dict, List, Optional
+
+from telegram import Bot
+
+from config import (
+    BOT_TOKEN, DATABASE_PATH, BROADCAST_RATE_LIMIT, PER_CHAT_RATE_LIMIT, BROADCAST_CONCURRENCY,
+    BROADCAST_BATCH_SIZE, SEND_MAX_ATTEMPTS, SEND_RETRY_BASE_DELAY, SEND_RETRY_MAX_DELAY,
+    BULK_CONNECTION_POOL_SIZE, BULK_REQUEST_TIMEOUT, SENDER_BOT_TOKENS, METRICS_LISTEN, METRICS_PORT,
+    LOG_RATE_LIMIT, LOG_SAMPLE_RATES, SENDER_WORKER_RATE_SHARE
+)
+from db import Database, AsyncDatabase
+from delivery import RateLimiter, RetryPolicy, DeliveryEngine, Sender, SenderPool, PooledDeliveryEngine
+from broadcast import BroadcastManager, ShardClaimLost, build_bulk_bot
+from metrics import MetricsServer
+from log_setup import setup_logging, parse_sample_rates
+from payloads import MediaMirror
+
+logger = logging.getLogger(__name__)
+
+# A worker renews its claim this often while sending a shard
+HEARTBEAT_INTERVAL = 10
+# Claims without a heartbeat for this long are taken over by another worker
+SHARD_STALE_AFTER = 60
+# Seconds between looks for new work when there is none
+IDLE_POLL_INTERVAL = 1.0
+
+
+class SenderWorker:
+    """Claims and delivers broadcast shards until cancelled"""
+
+    def __init__(self, db: AsyncDatabase, broadcasts: BroadcastManager, bot: Bot, owner: str):
+        self.db = db
+        self.broadcasts = broadcasts
+        self.bot = bot
+        self.owner = owner
+
+    async def _heartbeat(self, job_id: int, shard: int):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self.db.heartbeat_broadcast_shard(job_id, shard, self.owner)
+            except Exception as e:
+                logger.error(f"Failed to renew claim on job {job_id} shard {shard}: {e}")
+
+    async def run(self):
+        """Deliver claimed shards one after another, forever"""
+        while True:
+            try:
+                claim = await self.db.claim_broadcast_shard(self.owner, SHARD_STALE_AFTER)
+            except Exception as e:
+                logger.error(f"Failed to claim a broadcast shard: {e}", exc_info=True)
+                claim = None
+            if claim is None:
+                await asyncio.sleep(IDLE_POLL_INTERVAL)
+                continue
+
+            job_id, shard = claim["job_id"], claim["shard"]
+            logger.info(
+                f"Sending job {job_id} shard {shard} after user {claim['cursor']}: "
+                f"{claim['success'] + claim['failed']}/{claim['total']} done"
+            )
+            heartbeat = asyncio.create_task(self._heartbeat(job_id, shard))
+            try:
+                await self.broadcasts.run_shard(job_id, shard, self.bot, self.owner)
+            except ShardClaimLost as e:
+                # Our heartbeat went stale and another worker resumed the shard from its checkpoint
+                logger.warning(f"Stopped sending job {job_id} shard {shard}: {e}")
+            except Exception as e:
+                # The claim goes stale without heartbeats and the shard is retried from its checkpoint
+                logger.error(f"Failed to send job {job_id} shard {shard}: {e}", exc_info=True)
+                await asyncio.sleep(IDLE_POLL_INTERVAL)
+            finally:
+                heartbeat.cancel()
+
+
+class SenderWorkerPool:
+    """Starts the sender worker processes from the bot process and restarts any that exit"""
+
+    RESTART_DELAY = 5
+
+    def __init__(self, workers: int, base_url: Optional[str] = None):
+        self.workers = workers
+        self.base_url = base_url
+        self._tasks: List[asyncio.Task] = []
+        self._processes: Dict[int, asyncio.subprocess.Process] = {}
+
+    def _command(self, index: int) -> List[str]:
+        command = [sys.executable, os.path.abspath(__file__), "--workers", str(self.workers)]
+        if self.base_url:
+            command += ["--base-url", self.base_url]
+        if METRICS_PORT:
+            command += ["--metrics-port", str(METRICS_PORT + 1 + index)]
+        return command
+
+    async def _supervise(self, index: int):
+        while True:
+            process = await asyncio.create_subprocess_exec(*self._command(index))
+            self._processes[index] = process
+            logger.info(f"Sender worker {index} started (pid {process.pid})")
+            code = await process.wait()
+            logger.warning(f"Sender worker {index} exited with code {code}, restarting in {self.RESTART_DELAY}s")
+            await asyncio.sleep(self.RESTART_DELAY)
+
+    def start(self):
+        """Start every worker process"""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._supervise(index)) for index in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Stop the worker processes, killing any that do not exit within timeout seconds"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+        for process in self._processes.values():
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        self._processes = {}
+
+
+async def run_worker(workers: int, base_url: Optional[str] = None, metrics_port: int = 0):
+    """Run one sender worker until SIGTERM/SIGINT"""
+    db = Database(DATABASE_PATH)
+    adb = AsyncDatabase(db)
+    concurrency = math.ceil(BROADCAST_CONCURRENCY / workers)
+    retry_policy = RetryPolicy(SEND_MAX_ATTEMPTS, SEND_RETRY_BASE_DELAY, SEND_RETRY_MAX_DELAY)
+
+    # This worker's share of every bot token's budget, minus what is kept for replies to users
+    worker_rate = BROADCAST_RATE_LIMIT * SENDER_WORKER_RATE_SHARE / workers
+    senders = [
+        Sender(
+            index,
+            build_bulk_bot(token, base_url, BULK_CONNECTION_POOL_SIZE, BULK_REQUEST_TIMEOUT),
+            RateLimiter(worker_rate, PER_CHAT_RATE_LIMIT)
+        )
+        for index, token in enumerate([BOT_TOKEN] + SENDER_BOT_TOKENS)
+    ]
+    if len(senders) > 1:
+        delivery_engine = PooledDeliveryEngine(SenderPool(senders), concurrency, retry_policy)
+    else:
+        delivery_engine = DeliveryEngine(senders[0].rate_limiter, concurrency, retry_policy)
+    bot = senders[0].bot
+    broadcasts = BroadcastManager(
+        adb, delivery_engine, batch_size=BROADCAST_BATCH_SIZE, mirror=MediaMirror(bot, len(SENDER_BOT_TOKENS))
+    )
+    worker = SenderWorker(adb, broadcasts, bot, owner=f"{socket.gethostname()}:{os.getpid()}")
+
+    metrics_server = MetricsServer(METRICS_LISTEN, metrics_port)
+    if metrics_port:
+        await metrics_server.start()
+    for sender in senders:
+        await sender.bot.initialize()
+    task = asyncio.create_task(worker.run())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, task.cancel)
+        except NotImplementedError:
+            # Windows event loops do not support signal handlers
+            pass
+
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for sender in senders:
+            await sender.bot.shutdown()
+        await metrics_server.stop()
+        adb.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sender worker for sharded broadcasts")
+    parser.add_argument("--workers", type=int, required=True, help="total number of sender workers")
+    parser.add_argument("--base-url", default=None, help="Bot API base URL (for testing)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve this worker's metrics on this port")
+    args = parser.parse_args()
+
+    setup_logging(
+        f'%(asctime)s - sender[{os.getpid()}] - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        rate=LOG_RATE_LIMIT,
+        sample_rates=parse_sample_rates(LOG_SAMPLE_RATES)
+    )
+    asyncio.run(run_worker(max(1, args.workers), args.base_url, args.metrics_port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database, AsyncDatabase  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    db = Database(str(tmp_path / "bot_database.db"))
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def adb(database):
+    adb = AsyncDatabase(database)
+    yield adb
+    adb._executor.shutdown(wait=True)
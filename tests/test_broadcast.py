@@ -0,0 +1,177 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from broadcast import BroadcastManager, JOB_AUTO, JOB_BROADCAST
+from delivery import DeliveryEngine, PooledDeliveryEngine, RateLimiter, Sender, SenderPool
+from payloads import MediaMirror
+
+
+class FakeBot:
+    """Records every send_message instead of calling Telegram"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+
+
+def add_users(database, count):
+    database.add_users_many([(user_id, f"user{user_id}", "User", 1) for user_id in range(1, count + 1)])
+
+
+def fail_once(database, method_name, error):
+    """Make database.method_name raise error on its first call only"""
+    original = getattr(database, method_name)
+    calls = {"count": 0}
+
+    def method(*args, **kwargs):
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise error
+        return original(*args, **kwargs)
+
+    setattr(database, method_name, method)
+
+
+def make_manager(adb, batch_size=10):
+    return BroadcastManager(adb, DeliveryEngine(RateLimiter(10000, 0), concurrency=4), batch_size=batch_size)
+
+
+def test_failed_checkpoint_keeps_outcomes_and_job_resumes(database, adb):
+    add_users(database, 50)
+    fail_once(database, "update_last_message_sent_many", sqlite3.OperationalError("database is locked"))
+    bot = FakeBot()
+
+    async def run():
+        manager = make_manager(adb)
+        job_id = await manager.create_job(JOB_AUTO, "hello")
+        with pytest.raises(sqlite3.OperationalError):
+            await manager.run_job(job_id, bot)
+        # Only whole batches were confirmed, so the counts match the cursor the job resumes from
+        job = await adb.get_broadcast_job(job_id)
+        assert job["status"] == "running"
+        assert job["success"] == job["cursor"] < 50
+        return await manager.run_job(job_id, bot)
+
+    job = asyncio.run(run())
+    assert job["status"] == "done"
+    assert job["success"] == 50
+    assert set(bot.sent) == set(range(1, 51))
+    with database._get_connection() as conn:
+        missing = conn.execute("SELECT COUNT(*) FROM users WHERE last_message_sent IS NULL").fetchone()[0]
+    assert missing == 0
+
+
+def test_failed_checkpoint_restores_buffered_outcomes(database, adb):
+    add_users(database, 3)
+    fail_once(database, "checkpoint_broadcast_job", sqlite3.OperationalError("database is locked"))
+
+    async def run():
+        from broadcast import DeliveryResults
+        job_id = await adb.create_broadcast_job(JOB_AUTO, {"text": "hello"})
+        results = DeliveryResults(adb, job_id, 0, update_last_sent=True)
+        for user_id in (1, 2, 3):
+            results.dispatched(user_id)
+        results.record_sent(1)
+        results.record_failed(2, blocked=True)
+        with pytest.raises(sqlite3.OperationalError):
+            await results.checkpoint()
+        assert (results.success, results.failed, results.sent, results.blocked) == (1, 1, [1], [2])
+        results.record_sent(3)
+        assert await results.checkpoint()
+        return await adb.get_broadcast_job(job_id)
+
+    job = asyncio.run(run())
+    assert (job["cursor"], job["success"], job["failed"]) == (3, 2, 1)
+
+
+class SlowBot(FakeBot):
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0.01)
+        await super().send_message(chat_id, text, **kwargs)
+
+
+def test_stop_saves_progress_and_job_resumes(database, adb):
+    add_users(database, 200)
+    bot = SlowBot()
+
+    async def run():
+        manager = make_manager(adb)
+        job_id = await manager.create_job(JOB_AUTO, "hello")
+        task = manager.start_job(job_id, bot)
+        while len(bot.sent) < 50 and not task.done():
+            await asyncio.sleep(0.01)
+        await manager.stop()
+        job = await adb.get_broadcast_job(job_id)
+        # Everything delivered before the stop is saved, including the last partial batch
+        assert job["status"] == "running"
+        assert job["success"] == len(bot.sent) < 200
+        return await manager.run_job(job_id, bot)
+
+    job = asyncio.run(run())
+    assert job["success"] == 200
+    assert sorted(bot.sent) == list(range(1, 201))
+
+
+class MainBot(FakeBot):
+    """The main bot: copies messages and serves its files to the mirror"""
+
+    def __init__(self):
+        super().__init__()
+        self.copied = []
+
+    async def copy_messages(self, chat_id, from_chat_id, message_ids):
+        self.copied.append(chat_id)
+
+    async def get_file(self, file_id):
+        async def download_as_bytearray():
+            return bytearray(file_id.encode())
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+
+class SenderBot(FakeBot):
+    """A sender bot: records media groups and answers with new file_ids"""
+
+    def __init__(self):
+        super().__init__()
+        self.groups = []
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self.groups.append((chat_id, media))
+        return tuple(
+            SimpleNamespace(effective_attachment=SimpleNamespace(file_id=f"sender-{index}"))
+            for index, _ in enumerate(media)
+        )
+
+
+def test_sender_bot_sends_album_files_it_cannot_copy(database, adb):
+    # Users 1-2 started the main bot too; users 3-4 only the sender bot
+    database.add_users_many([(1, "a", "A", 3), (2, "b", "B", 3), (3, "c", "C", 2), (4, "d", "D", 2)])
+    main_bot, sender_bot = MainBot(), SenderBot()
+    pool = SenderPool([Sender(0, main_bot, RateLimiter(10000, 0)), Sender(1, sender_bot, RateLimiter(10000, 0))])
+    manager = BroadcastManager(adb, PooledDeliveryEngine(pool, concurrency=1), mirror=MediaMirror(main_bot))
+    media = [
+        {"file_id": "photo1", "file_type": "photo", "file_name": "photo.jpg", "caption": "<b>Hi</b>"},
+        {"file_id": "video1", "file_type": "video", "file_name": "video.mp4", "caption": None},
+    ]
+
+    async def run():
+        job_id = await manager.create_job(
+            JOB_BROADCAST, "<b>Hi</b>", photo="photo1", from_chat_id=99, message_ids=[11, 12],
+            media=media, parse_mode="HTML"
+        )
+        return await manager.run_job(job_id, main_bot)
+
+    job = asyncio.run(run())
+    assert job["success"] == 4
+    assert sorted(main_bot.copied) == [1, 2]
+    assert [chat_id for chat_id, _ in sender_bot.groups] == [3, 4]
+    # The second send reuses the file_ids of the first upload
+    first, second = (group for _, group in sender_bot.groups)
+    assert [item.media.input_file_content for item in first] == [b"photo1", b"video1"]
+    assert [item.media for item in second] == ["sender-0", "sender-1"]
+    assert first[0].caption == "<b>Hi</b>" and first[0].parse_mode == "HTML"
@@ -0,0 +1,105 @@
+import sqlite3
+from datetime import datetime, timezone
+
+from broadcast import JOB_BROADCAST
+from db import Database, _migration_initial_schema
+from test_broadcast import add_users
+
+
+def test_shard_checkpoint_requires_current_owner(database):
+    add_users(database, 10)
+    job_id = database.create_broadcast_job(JOB_BROADCAST, {"text": "hi"}, shards=2)
+    claimed = database.claim_broadcast_shard("worker-a")
+    shard = claimed["shard"]
+
+    # A worker whose claim was taken over must not move the cursor or add its counts
+    assert not database.checkpoint_broadcast_shard(job_id, shard, 3, 3, 0, "worker-b")
+    assert not database.finish_broadcast_shard(job_id, shard, "worker-b")
+    assert database.get_broadcast_shard(job_id, shard)["status"] == "running"
+    assert database.get_broadcast_job(job_id)["success"] == 0
+
+    assert database.checkpoint_broadcast_shard(job_id, shard, 3, 3, 0, "worker-a")
+    assert database.get_broadcast_shard(job_id, shard)["cursor"] == 3
+    assert database.get_broadcast_job(job_id)["success"] == 3
+    assert not database.finish_broadcast_shard(job_id, shard, "worker-a")  # the other shard still runs
+    assert database.get_broadcast_shard(job_id, shard)["status"] == "done"
+
+
+def test_claim_skips_owned_shards(database):
+    add_users(database, 10)
+    database.create_broadcast_job(JOB_BROADCAST, {"text": "hi"}, shards=2)
+    first = database.claim_broadcast_shard("worker-a")
+    second = database.claim_broadcast_shard("worker-b")
+
+    assert first["shard"] != second["shard"]
+    assert database.claim_broadcast_shard("worker-c") is None
+
+
+def make_baseline_database(path, users):
+    """A database as the version before migrations left it, with (user_id, is_active, last_message_sent) rows"""
+    conn = sqlite3.connect(path)
+    _migration_initial_schema(conn.cursor())
+    conn.executemany("INSERT INTO users (user_id, is_active, last_message_sent) VALUES (?, ?, ?)", users)
+    conn.commit()
+    conn.close()
+    return Database(path)
+
+
+def test_upgrade_spreads_users_messaged_in_one_batch(tmp_path):
+    # Everyone got the last batch in the same second
+    database = make_baseline_database(
+        str(tmp_path / "old.db"), [(user_id, 1, "2024-01-01 12:00:00") for user_id in range(1, 1001)]
+    )
+    try:
+        with database._get_connection() as conn:
+            due = [row[0] for row in conn.execute("SELECT next_auto_message_at FROM users")]
+    finally:
+        database.close()
+
+    last_sent = int(datetime(2024, 1, 1, 12, tzinfo=timezone.utc).timestamp())
+    interval = 8 * 3600
+    assert all(last_sent + interval <= at < last_sent + 2 * interval for at in due)
+    assert len(set(due)) == 1000
+    assert max(due) - min(due) > interval * 0.9
+
+
+def counted(database):
+    with database._get_connection() as conn:
+        total, active = conn.execute("SELECT COUNT(*), COALESCE(SUM(is_active = 1), 0) FROM users").fetchone()
+    return {"total_users": total, "active_users": active}
+
+
+def test_stats_counters_follow_user_changes(database):
+    assert database.get_stats() == counted(database) == {"total_users": 0, "active_users": 0}
+
+    database.add_user(1, "one", "One")
+    assert database.get_stats() == counted(database)
+
+    add_users(database, 10)  # user 1 again through the upsert, 2-10 new
+    assert database.get_stats() == counted(database) == {"total_users": 10, "active_users": 10}
+
+    database.mark_users_inactive_many([2, 3, 4, 4], chunk_size=2)
+    database.mark_user_inactive(5)
+    database.mark_users_inactive_many([5])  # already inactive
+    assert database.get_stats() == counted(database) == {"total_users": 10, "active_users": 6}
+
+    # Blocked users who start the bot again are active again, and counted once
+    database.add_users_many([(2, "two", "Two", 2), (3, "three", "Three", 1), (11, "new", "New", 1)])
+    database.add_user(4)
+    assert database.get_stats() == counted(database) == {"total_users": 11, "active_users": 10}
+
+    with database._get_connection() as conn:
+        conn.execute("DELETE FROM users WHERE user_id IN (1, 5)")
+    assert database.get_stats() == counted(database) == {"total_users": 9, "active_users": 9}
+
+
+def test_upgrade_counts_existing_users(tmp_path):
+    database = make_baseline_database(
+        str(tmp_path / "old.db"), [(user_id, user_id % 3 != 0, None) for user_id in range(1, 301)]
+    )
+    try:
+        assert database.get_stats() == counted(database) == {"total_users": 300, "active_users": 200}
+        database.add_users_many([(3, "back", "Back", 1), (301, "new", "New", 1)])
+        assert database.get_stats() == counted(database) == {"total_users": 301, "active_users": 202}
+    finally:
+        database.close()
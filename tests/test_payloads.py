@@ -0,0 +1,69 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram import InputFile
+
+from payloads import MediaMirror
+
+
+class SourceBot:
+    """The main bot the mirror downloads files through"""
+
+    def __init__(self):
+        self.downloads = 0
+
+    async def get_file(self, file_id):
+        self.downloads += 1
+
+        async def download_as_bytearray():
+            await asyncio.sleep(0.01)
+            return bytearray(file_id.encode())
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+
+def upload(uploads, fail=False):
+    """A send that records the media it got and answers like Telegram, with a new file_id for uploads"""
+    async def send(media):
+        uploads.append(media[0])
+        await asyncio.sleep(0.01)
+        if fail:
+            raise RuntimeError("send failed")
+        file_id = "mirrored" if isinstance(media[0], InputFile) else media[0]
+        return SimpleNamespace(effective_attachment=SimpleNamespace(file_id=file_id))
+    return send
+
+
+def test_concurrent_sends_upload_a_file_once():
+    source = SourceBot()
+    mirror = MediaMirror(source, senders=2)
+    sent = []
+
+    async def run():
+        await asyncio.gather(*(mirror.send(1, [("fid", "a.jpg")], upload(sent)) for _ in range(20)))
+        # Kept for sender bot 2, which has not got the file yet
+        assert "fid" in mirror._downloads
+        await mirror.send(2, [("fid", "a.jpg")], upload(sent))
+
+    asyncio.run(run())
+    assert source.downloads == 1
+    assert sum(isinstance(media, InputFile) for media in sent) == 2
+    assert sent.count("mirrored") == 19
+    assert mirror._downloads == {}
+
+
+def test_failed_upload_lets_the_next_send_upload():
+    source = SourceBot()
+    mirror = MediaMirror(source, senders=1)
+    sent = []
+
+    async def run():
+        first = asyncio.ensure_future(mirror.send(1, [("fid", "a.jpg")], upload(sent, fail=True)))
+        waiting = asyncio.ensure_future(mirror.send(1, [("fid", "a.jpg")], upload(sent)))
+        with pytest.raises(RuntimeError):
+            await first
+        await waiting
+
+    asyncio.run(run())
+    assert [isinstance(media, InputFile) for media in sent] == [True, True]
+    assert mirror._file_ids[(1, "fid")] == "mirrored"
@@ -0,0 +1,46 @@
+import time
+
+from request_guard import RequestGuard, REASON_DUPLICATE, REASON_FLOOD
+
+
+def test_repeat_within_debounce_is_duplicate(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    guard = RequestGuard(debounce=3, per_minute=60)
+
+    assert guard.suppressed(1, "download") is None
+    assert guard.suppressed(1, "download") == REASON_DUPLICATE
+    # Another action, another bot or another user is not a repeat
+    assert guard.suppressed(1, "start") is None
+    assert guard.suppressed(1, "download", bot_index=1) is None
+    assert guard.suppressed(2, "download") is None
+    now[0] += 3
+    assert guard.suppressed(1, "download") is None
+
+
+def test_flood_once_bucket_is_empty(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    guard = RequestGuard(debounce=0, per_minute=6, burst=2)
+
+    assert guard.suppressed(1, "start") is None
+    assert guard.suppressed(1, "download") is None
+    assert guard.suppressed(1, "start") == REASON_FLOOD
+    assert guard.suppressed(2, "start") is None
+    # One request refills every 10 seconds
+    now[0] += 10
+    assert guard.suppressed(1, "start") is None
+    assert guard.suppressed(1, "start") == REASON_FLOOD
+
+
+def test_tables_stay_within_max_users(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    guard = RequestGuard(debounce=3, per_minute=60, max_users=10)
+
+    for user_id in range(100):
+        assert guard.suppressed(user_id, "start") is None
+    assert len(guard._recent) <= 10
+    assert len(guard._buckets) <= 10
+    # The most recent users are kept
+    assert guard.suppressed(99, "start") == REASON_DUPLICATE
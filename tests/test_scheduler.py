@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from broadcast import BroadcastManager
+from delivery import DeliveryEngine, RateLimiter
+from scheduler import MessageScheduler, AUTO_MODE_BATCH, AUTO_MODE_SPREAD
+from test_broadcast import FakeBot, add_users
+
+
+def make_scheduler(adb, bot):
+    broadcasts = BroadcastManager(adb, DeliveryEngine(RateLimiter(10000, 0), concurrency=4), batch_size=10)
+    return MessageScheduler(adb, bot, broadcasts, tick_seconds=0)
+
+
+def make_everyone_due(database):
+    with database._get_connection() as conn:
+        conn.execute("UPDATE users SET next_auto_message_at = ?", (int(time.time()) - 1,))
+
+
+def test_batch_job_advances_next_due_so_spread_does_not_resend(database, adb):
+    add_users(database, 100)
+    database.set_setting("auto_message_text", "hello")
+    make_everyone_due(database)
+    bot = FakeBot()
+    scheduler = make_scheduler(adb, bot)
+
+    async def run():
+        # spread -> batch: the batch goes out to everyone
+        database.set_setting("auto_message_mode", AUTO_MODE_BATCH)
+        database.set_setting("auto_message_next_run", str(int(time.time()) - 1))
+        await scheduler.run_batch_if_due(mode_changed=False)
+        assert len(bot.sent) == 100
+
+        # batch -> spread right away: nobody is due again for another interval
+        database.set_setting("auto_message_mode", AUTO_MODE_SPREAD)
+        await scheduler.send_due_auto_messages()
+
+    asyncio.run(run())
+    assert len(bot.sent) == 100
+
+
+def test_spread_sends_once_per_interval(database, adb):
+    add_users(database, 20)
+    database.set_setting("auto_message_text", "hello")
+    bot = FakeBot()
+    scheduler = make_scheduler(adb, bot)
+
+    async def run():
+        # New users are scheduled one interval ahead, not messaged right away
+        await scheduler.send_due_auto_messages()
+        assert bot.sent == []
+        make_everyone_due(database)
+        await scheduler.send_due_auto_messages()
+        await scheduler.send_due_auto_messages()
+
+    asyncio.run(run())
+    assert sorted(bot.sent) == list(range(1, 21))
+
+
+def test_unfinished_auto_job_is_restarted(database, adb):
+    add_users(database, 30)
+    database.set_setting("auto_message_text", "hello")
+    make_everyone_due(database)
+    bot = FakeBot()
+    scheduler = make_scheduler(adb, bot)
+
+    async def run():
+        # A job whose task died: unfinished in the database, nothing running it
+        job_id = await scheduler.broadcasts.create_auto_job("hello", 3600)
+        await scheduler.send_due_auto_messages()
+        return await adb.get_broadcast_job(job_id)
+
+    job = asyncio.run(run())
+    assert job["status"] == "done"
+    assert sorted(bot.sent) == list(range(1, 31))
+
+
+def due_times(database):
+    with database._get_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT next_auto_message_at FROM users ORDER BY user_id")]
+
+
+def test_due_times_stay_spread_over_the_interval(database, adb, monkeypatch):
+    add_users(database, 500)
+    database.set_setting("auto_message_text", "hello")
+    interval = 8 * 3600
+    start = int(time.time())
+    clock = [start]
+    monkeypatch.setattr(time, "time", lambda: clock[0])
+    bot = FakeBot()
+    scheduler = make_scheduler(adb, bot)
+
+    async def run():
+        # A batch goes to everyone at once ...
+        await scheduler.send_auto_messages()
+        batch_due = due_times(database)
+        assert all(start + interval <= at < start + 2 * interval for at in batch_due)
+        # ... but after switching to spread they are due one by one
+        assert len(set(batch_due)) == 500
+        assert max(batch_due) - min(batch_due) > interval * 0.9
+
+        # Halfway through the next interval about half of them are due; each keeps their slot
+        clock[0] = start + interval + interval // 2
+        await scheduler.send_due_auto_messages()
+        return batch_due, due_times(database)
+
+    batch_due, spread_due = asyncio.run(run())
+    sent = [before for before in batch_due if before <= clock[0]]
+    assert 150 < len(sent) < 350
+    assert len(bot.sent) == 500 + len(sent)
+    for before, after in zip(batch_due, spread_due):
+        assert after == (before + interval if before <= clock[0] else before)
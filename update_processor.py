@@ -0,0 +1,61 @@
+import asyncio
+from typing import Any, Awaitable, Dict, Optional, Tuple
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping each user's updates in order
+
+    Updates sharing a (chat_id, user_id) key run one after another in arrival order, the
+    same key ConversationHandler uses with per_chat/per_user, so admin conversation states
+    stay consistent. Updates for different keys run in parallel, up to
+    max_concurrent_updates handlers at a time.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: Optional[int] = None):
+        # The base semaphore bounds admitted updates, including ones queued behind their key;
+        # running handlers are bounded separately so queued updates never hold a worker slot
+        super().__init__(max_pending_updates or max_concurrent_updates * 4)
+        self._workers = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: Dict[Tuple, asyncio.Lock] = {}
+        self._waiting: Dict[Tuple, int] = {}
+
+    @staticmethod
+    def _ordering_key(update: object) -> Optional[Tuple]:
+        if not isinstance(update, Update):
+            return None
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat is None and user is None:
+            return None
+        return (chat.id if chat else None, user.id if user else None)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        key = self._ordering_key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            # asyncio.Lock wakes waiters first-in first-out, which preserves arrival order
+            async with lock:
+                async with self._workers:
+                    await coroutine
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                # Forget idle keys so the maps only hold users with updates in flight
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass